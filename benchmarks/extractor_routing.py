@@ -0,0 +1,55 @@
+# compares the per-call latency of picking a yt-dlp extractor for a url
+# the old way (instantiating and scanning every extractor) against `metadatagetter.get_extractor`.
+#
+# usage: python -m benchmarks.extractor_routing [iterations]
+import sys
+import time
+import statistics
+
+import yt_dlp
+
+from libs.namumusic import metadatagetter
+
+URLS = [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtu.be/dQw4w9WgXcQ",
+    "https://www.youtube.com/playlist?list=PLFsQleAWXsj_4yDeebiIADdH5FMayBiJo",
+    "https://soundcloud.com/toby-fox-official/megalovania",
+    "https://tobyfox.bandcamp.com/album/undertale-soundtrack",
+]
+
+def full_scan(url: str) -> str:
+    extractor = ""
+    for e in yt_dlp.extractor.gen_extractors():
+        if e.suitable(url) and e.IE_NAME != 'generic':
+            extractor = (e.IE_NAME+" ")[:e.IE_NAME.find(":")]
+    return extractor.lower()
+
+def measure(function, url: str, iterations: int) -> list:
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter_ns()
+        function(url)
+        timings.append((time.perf_counter_ns() - start) / 1e6)
+    return timings
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    start = time.perf_counter()
+    metadatagetter.load_extractors()
+    print(f"building the extractor list once: {(time.perf_counter() - start) * 1e3:.2f}ms\n")
+
+    print(f"{'url':<75} {'extractor':>12} {'full scan':>12} {'first call':>12} {'cached':>12}")
+    for url in URLS:
+        full = statistics.median(measure(full_scan, url, max(1, iterations // 10)))
+        metadatagetter._host_extractors.clear()
+        first = measure(metadatagetter.get_extractor, url, 1)[0]
+        cached = statistics.median(measure(metadatagetter.get_extractor, url, iterations))
+        extractor = metadatagetter.get_extractor(url)
+        if extractor != full_scan(url):
+            extractor += " (mismatch)"
+        print(f"{url:<75} {extractor:>12} {full:>10.3f}ms {first:>10.3f}ms {cached:>10.3f}ms")
+
+if __name__ == "__main__":
+    main()
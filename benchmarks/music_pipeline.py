@@ -0,0 +1,142 @@
+# runs the real music pipeline (decode -> normalize -> opus encode -> gain/crossfade -> mix -> read)
+# for N simulated guilds without connecting to discord or yt-dlp.
+# songs are synthetic pcm by default, or a local file decoded by ffmpeg with --file.
+#
+# two scenarios get measured for every guild count:
+# - single: one song per guild, the usual case (opus passthrough if libopus is available)
+# - crossfade: two songs per guild mixed together the whole time, the worst case
+#
+# usage: python -m benchmarks.music_pipeline [--guilds 1 10 50] [--seconds 10] [--length 180] [--file song.mp3] [--effects] [--speed 1.25]
+import argparse
+import asyncio
+import resource
+import time
+
+import numpy
+
+from libs.namumusic import pcm
+from libs.namumusic.dsp import DSPChain, BassBoost, Equalizer, Speed
+from libs.namumusic.metadata import Metadata
+from libs.namumusic.metrics import GuildMetrics
+from libs.namumusic.pcmcache import PCMCache
+from libs.namumusic.pcmtrack import PCMTrack, Status, DecodePriority
+from libs.namumusic.ytdlpaudio import YTDLPAudio
+from libs.namumusic.ytdlpmusicplayer import YTDLPMusicPlayer
+
+class FakeVoiceClient():
+    def is_playing(self) -> bool:
+        return True
+
+    def play(self, *args, **kwargs) -> None:
+        pass
+
+    def stop(self) -> None:
+        pass
+
+def synthesize(seed: int, length: float) -> numpy.ndarray:
+    # a few seconds of silence on both ends so silence trimming has something to do
+    rng = numpy.random.default_rng(seed)
+    samples = int(length * pcm.FRAME_LENGTH * 50)
+    t = numpy.arange(samples) / 48000
+    signal = 4000 * numpy.sin(2 * numpy.pi * (220 + 20 * seed) * t) + rng.normal(0, 800, samples)
+    signal[:48000 * 2] = 0
+    signal[-48000 * 2:] = 0
+    return signal.astype(numpy.int16)
+
+def decode_track(track: PCMTrack, seed: int, length: float, file: str = None) -> float:
+    start = time.perf_counter()
+    if file:
+        track.open_ffmpeg(file)
+        track.read_ffmpeg()
+    else:
+        track.status = Status.LOADING
+        signal = synthesize(seed, length).tobytes()
+        for offset in range(0, len(signal) - pcm.MONO_FRAME_SIZE + 1, pcm.MONO_FRAME_SIZE):
+            track.ingest(signal[offset:offset+pcm.MONO_FRAME_SIZE])
+        track.finish()
+    # only songs that are playing (or up next) get encoded
+    track.priority = DecodePriority.PLAYING
+    while not track.encode():
+        pass
+    return time.perf_counter() - start
+
+async def create_guild(index: int, songs: int, pcm_cache: PCMCache, args) -> tuple:
+    player = YTDLPMusicPlayer(FakeVoiceClient(), pcm_cache=pcm_cache, metrics=GuildMetrics(index))
+    effects = [Speed(args.speed)]
+    if args.effects:
+        effects += [BassBoost(6.0), Equalizer([(250.0, -3.0, 0.7), (8000.0, 3.0, 0.7)])]
+    player.set_effects(DSPChain(effects))
+    decode_seconds = 0.0
+    for song in range(songs):
+        # every guild plays different songs unless --shared, then they all hit the same tracks in the cache
+        seed = song if args.shared else index * songs + song
+        audio: YTDLPAudio = await player.create_audio(Metadata(url=f"synthetic://{seed}", stream_url=args.file or f"synthetic://{seed}", title=f"song {seed}"))
+        track = audio.acquire_track()
+        if track.status == Status.IDLE:
+            decode_seconds += decode_track(track, seed, args.length, args.file)
+        track.subscribe(audio.on_track_done)
+        # looping keeps the songs from ending (and calling back into the event loop) mid benchmark
+        audio.set_loop(True)
+        # start somewhere in the song so the crossfade and the silence skipping both show up
+        audio.packet_index = (index * 997) % max(1, len(track.packets) - 1)
+        player.queue.append(audio)
+        player.mixer.add_audio_source("music", audio)
+    return player, decode_seconds
+
+def run_players(players: list, seconds: float) -> list:
+    # reads one frame per guild per tick like discord.py's audio threads would, as fast as possible
+    timings = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for player in players:
+            start = time.perf_counter_ns()
+            player.mixer.read()
+            timings.append(time.perf_counter_ns() - start)
+    return timings
+
+async def run_scenario(guilds: int, songs: int, args) -> None:
+    pcm_cache = PCMCache(memory_budget=1 << 40)
+    created = [await create_guild(index, songs, pcm_cache, args) for index in range(guilds)]
+    players = [player for player, _ in created]
+    decode_seconds = sum(seconds for _, seconds in created)
+    tracks = list(pcm_cache.tracks.values())
+
+    # the songs call back into the event loop (e.g. `on_start`), so they get read on another thread like in discord.py
+    timings = numpy.array(await asyncio.get_running_loop().run_in_executor(None, run_players, players, args.seconds))
+    frames = len(timings)
+    audio_seconds = sum(len(track.packets) for track in tracks) * 0.02
+    pcm_bytes = sum(track.packets.nbytes for track in tracks) / len(tracks)
+    opus_bytes = sum(track.opus_nbytes for track in tracks) / len(tracks)
+    opus_frames = sum(player.metrics.opus_frames for player in players)
+
+    print(f"{'crossfade' if songs > 1 else 'single':<10} {guilds:>6} "
+          f"{frames / (timings.sum() / 1e9):>12.0f} "
+          f"{numpy.percentile(timings, 50) / 1e3:>10.1f}us {numpy.percentile(timings, 99) / 1e3:>10.1f}us "
+          f"{frames / guilds / args.seconds / 50:>9.1f}x "
+          f"{audio_seconds / decode_seconds if decode_seconds else 0:>9.0f}x "
+          f"{pcm_bytes / 1024 / 1024:>8.2f}MB {opus_bytes / 1024 / 1024:>8.2f}MB {opus_frames / frames:>7.0%}")
+
+    for player in players:
+        player.self_clean_up()
+    pcm_cache.clear()
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--guilds", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--seconds", type=float, default=5.0, help="how long to read frames for in every scenario")
+    parser.add_argument("--length", type=float, default=180.0, help="length of the synthetic songs in seconds")
+    parser.add_argument("--file", help="decode this file with ffmpeg instead of generating the songs")
+    parser.add_argument("--shared", action="store_true", help="every guild plays the same songs")
+    parser.add_argument("--effects", action="store_true", help="bass boost and equalizer on every guild")
+    parser.add_argument("--speed", type=float, default=1.0, help="playback rate of every guild")
+    args = parser.parse_args()
+
+    # every guild reads a frame every 20ms, so the realtime column has to stay above 1x with headroom to spare
+    print(f"{'scenario':<10} {'guilds':>6} {'frames/s':>12} {'p50':>12} {'p99':>12} {'realtime':>10} {'decode':>10} {'pcm/track':>10} {'opus/track':>10} {'passthrough':>8}")
+    for guilds in args.guilds:
+        await run_scenario(guilds, 1, args)
+        await run_scenario(guilds, 2, args)
+    print(f"\npeak rss: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.1f}MB")
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,54 @@
+# compares writing and loading a vault value as a row tree ("rows") against a single blob ("binary").
+#
+# usage: python -m benchmarks.vault_codec [iterations]
+import os
+import sys
+import time
+import asyncio
+import logging
+import tempfile
+import statistics
+
+from libs.namuvaultmanager.vaultmanager import VaultManager
+from libs.namuvaultmanager import codec
+
+LOGGER = logging.getLogger("benchmarks.vault_codec")
+
+VALUES = {
+    "setting": True,
+    "25 channel ids": list(range(1000000000000000000, 1000000000000000025)),
+    "queue snapshot": {"position": 12.5, "index": 3, "songs": [{"url": f"https://youtu.be/{i:011d}", "title": f"song {i}", "duration": 180} for i in range(50)]},
+}
+
+async def measure(path: str, name: str, value, vault_codec: str, iterations: int):
+    vault_manager = VaultManager(path, logger=LOGGER, storage="single")
+    vault = await vault_manager.get(vault_codec)
+    vault.codec = vault_codec
+    rows = len(await vault_manager.get_execute_data(vault, 0, value))
+    await vault.store(name, value)
+    await vault_manager.close()
+    vault_manager.db.close()
+
+    loads = []
+    for _ in range(iterations):
+        # a fresh manager so the vault has to come from the database
+        vault_manager = VaultManager(path, logger=LOGGER, storage="single")
+        start = time.perf_counter_ns()
+        vault = await vault_manager.get(vault_codec)
+        loads.append((time.perf_counter_ns() - start) / 1e6)
+        assert vault.get(name) == value
+        vault_manager.db.close()
+    return rows, statistics.median(loads)
+
+async def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    print(f"{'value':<16} {'codec':>8} {'rows':>6} {'load':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for index, (name, value) in enumerate(VALUES.items()):
+            for vault_codec in codec.CODECS:
+                path = os.path.join(directory, f"{vault_codec}-{index}.db")
+                rows, load = await measure(path, name, value, vault_codec, iterations)
+                print(f"{name:<16} {vault_codec:>8} {rows:>6} {load:>8.3f}ms")
+
+if __name__ == "__main__":
+    asyncio.run(main())
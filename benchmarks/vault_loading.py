@@ -0,0 +1,91 @@
+# compares the ways `VaultManager.populate_dict_from_db_list` can decode a vault's rows across vault sizes:
+# a new thread pool for every load (how it used to work), always inline, always the shared pool, and the
+# adaptive default that switches at `INLINE_ROWS`. doesn't touch the database, only the decoding is measured.
+# next to how long a load takes it shows the longest the event loop was stuck during it, which is what
+# decoding inline costs the rest of the bot
+#
+# usage: python -m benchmarks.vault_loading [iterations]
+import sys
+import time
+import asyncio
+import logging
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+
+from libs.namuvaultmanager.vaultmanager import VaultManager, MAX_WORKERS, INLINE_ROWS
+
+SIZES = [1, 10, 50, 100, 250, 500, 1000, 4000, 10000, 100000]
+
+LOGGER = logging.getLogger("benchmarks.vault_loading")
+
+class PerCallVaultManager(VaultManager):
+    # a fresh pool every time one is needed, shut down once the load is done
+    async def populate_dict_from_db_list(self, array, dict):
+        self.executors = []
+        try:
+            await super().populate_dict_from_db_list(array, dict)
+        finally:
+            for executor in self.executors:
+                executor.shutdown()
+
+    def get_decode_executor(self):
+        executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        self.executors.append(executor)
+        return executor
+
+async def get_rows(count: int) -> list:
+    # settings mixed with lists of 25 ids (26 rows each), like a guild vault
+    rows = []
+    key = 0
+    while len(rows) < count:
+        key += 1
+        value = list(range(key, key + 25)) if key % 2 == 0 and count - len(rows) >= 26 else key
+        rows.extend(await VaultManager.walk_execute_data(key, value))
+    return rows
+
+async def tick(stalls: list):
+    last = time.perf_counter_ns()
+    while True:
+        await asyncio.sleep(0)
+        now = time.perf_counter_ns()
+        stalls[0] = max(stalls[0], (now - last) / 1e6)
+        last = now
+
+async def measure(vault_manager: VaultManager, rows: list, iterations: int) -> tuple:
+    timings = []
+    stalls = [0.0]
+    ticker = asyncio.create_task(tick(stalls))
+    await asyncio.sleep(0)
+    for _ in range(iterations):
+        data = {}
+        start = time.perf_counter_ns()
+        await vault_manager.populate_dict_from_db_list(rows, data)
+        timings.append((time.perf_counter_ns() - start) / 1e6)
+        # lets the ticker see the gap a load that never gave up the loop left behind
+        await asyncio.sleep(0)
+    ticker.cancel()
+    return statistics.median(timings), stalls[0]
+
+async def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    per_call = PerCallVaultManager(":memory:", logger=LOGGER)
+    per_call.inline_rows = 0
+    inline = VaultManager(":memory:", logger=LOGGER)
+    inline.inline_rows = float("inf")
+    shared = VaultManager(":memory:", logger=LOGGER)
+    shared.inline_rows = 0
+    adaptive = VaultManager(":memory:", logger=LOGGER)
+    strategies = {"per call pool": per_call, "inline": inline, "shared pool": shared, "adaptive": adaptive}
+
+    print(f"inline below {INLINE_ROWS} rows, {MAX_WORKERS} workers\n")
+    print("median load / longest event loop stall")
+    print(f"{'rows':>8} " + " ".join(f"{name:>22}" for name in strategies))
+    for size in SIZES:
+        rows = await get_rows(size)
+        # big vaults don't need as many runs to settle
+        runs = max(3, iterations * 100 // max(size, 100))
+        timings = [await measure(vault_manager, rows, runs) for vault_manager in strategies.values()]
+        print(f"{len(rows):>8} " + " ".join(f"{timing:>10.3f}ms /{stall:>8.2f}ms" for timing, stall in timings))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,89 @@
+# compares loading vaults cold (first `get` after the bot starts) with one table per vault ("tables")
+# against every vault in one table ("single"), and how long moving an existing database over takes.
+#
+# usage: python -m benchmarks.vault_storage [owners ...] [--loads N]
+import os
+import sys
+import time
+import random
+import asyncio
+import logging
+import tempfile
+import statistics
+
+from libs.namuvaultmanager.vaultmanager import VaultManager
+from libs.utils.hash import fnv1a_64_signed
+
+# otherwise every manager adds another handler to the root logger
+LOGGER = logging.getLogger("benchmarks.vault_storage")
+
+# roughly what a user vault looks like: a few settings and a list
+VALUE = {"githubUser": 1234567, "language": "en", "volume": 0.5, "playlist": ["https://youtu.be/dQw4w9WgXcQ"] * 8}
+
+async def get_rows():
+    keys, execute_data = [], []
+    for key, value in VALUE.items():
+        hashed_key = fnv1a_64_signed(key)
+        keys.append((hashed_key, hashed_key))
+        execute_data.extend(await VaultManager.walk_execute_data(hashed_key, value))
+    return keys, execute_data
+
+def seed(path: str, layout: str, owners: int, keys, execute_data) -> None:
+    vault_manager = VaultManager(path, logger=LOGGER, storage=layout)
+    with vault_manager.db as connection:
+        for owner in range(owners):
+            vault_manager.storage.store(connection, str(owner), None, keys, execute_data)
+    vault_manager.db.close()
+
+async def measure_loads(path: str, layout: str, owners: int, loads: int):
+    # a fresh manager every run so nothing is in the pool or the table cache yet
+    start = time.perf_counter()
+    vault_manager = VaultManager(path, logger=LOGGER, storage=layout)
+    opened = (time.perf_counter() - start) * 1e3
+    timings = []
+    for owner in random.Random(0).sample(range(owners), min(loads, owners)):
+        start = time.perf_counter_ns()
+        vault = await vault_manager.get(str(owner))
+        timings.append((time.perf_counter_ns() - start) / 1e6)
+        assert vault.get("githubUser") == VALUE["githubUser"]
+    tables = vault_manager.db.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchall()[0][0]
+    vault_manager.db.close()
+    return opened, tables, timings
+
+async def measure_migration(path: str):
+    vault_manager = VaultManager(path, logger=LOGGER, storage="single")
+    start = time.perf_counter()
+    await vault_manager.migrate(pause=0)
+    elapsed = time.perf_counter() - start
+    vault_manager.db.close()
+    return elapsed
+
+async def main():
+    args = sys.argv[1:]
+    loads = 200
+    if "--loads" in args:
+        index = args.index("--loads")
+        loads = int(args[index + 1])
+        del args[index:index + 2]
+    sizes = [int(arg) for arg in args] or [1000, 10000]
+    keys, execute_data = await get_rows()
+
+    print(f"{'owners':>8} {'layout':>8} {'tables':>8} {'file':>10} {'open':>10} {'median':>10} {'p95':>10}")
+    with tempfile.TemporaryDirectory() as directory:
+        for owners in sizes:
+            for layout in ("tables", "single"):
+                path = os.path.join(directory, f"{layout}-{owners}.db")
+                seed(path, layout, owners, keys, execute_data)
+                opened, tables, timings = await measure_loads(path, layout, owners, loads)
+                timings.sort()
+                size = os.path.getsize(path) / 1024 / 1024
+                print(f"{owners:>8} {layout:>8} {tables:>8} {size:>8.2f}MB {opened:>8.2f}ms "
+                      f"{statistics.median(timings):>8.3f}ms {timings[int(len(timings) * 0.95)]:>8.3f}ms")
+
+            path = os.path.join(directory, f"migrate-{owners}.db")
+            seed(path, "tables", owners, keys, execute_data)
+            elapsed = await measure_migration(path)
+            print(f"{owners:>8} moving every vault into one table: {elapsed:.2f}s ({elapsed / owners * 1e3:.3f}ms per vault)\n")
+
+if __name__ == "__main__":
+    asyncio.run(main())
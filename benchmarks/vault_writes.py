@@ -0,0 +1,44 @@
+# compares writing every `Vault.store` in its own transaction (how it used to work, done here by flushing
+# after every store) against letting the writes pile up and flushing them together.
+#
+# usage: python -m benchmarks.vault_writes [vaults] [writes per vault]
+import os
+import sys
+import time
+import asyncio
+import logging
+import tempfile
+
+from libs.namuvaultmanager.vaultmanager import VaultManager
+
+LOGGER = logging.getLogger("benchmarks.vault_writes")
+
+async def measure(path: str, vaults: int, writes: int, write_through: bool):
+    vault_manager = VaultManager(path, logger=LOGGER, storage="single", write_delay=3600)
+    loaded = [await vault_manager.get(str(owner)) for owner in range(vaults)]
+    start = time.perf_counter()
+    # settings toggles and music changes, the same few keys over and over
+    for i in range(writes):
+        for vault in loaded:
+            await vault.store({"volume": i / writes, "loop": i % 2 == 0})
+            if write_through:
+                await vault_manager.flush()
+    stored = time.perf_counter() - start
+    await vault_manager.close()
+    durable = time.perf_counter() - start
+    flushes = vault_manager.flushes
+    vault_manager.db.close()
+    return stored, durable, flushes
+
+async def main():
+    vaults = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    writes = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    print(f"{vaults} vaults, {writes} stores each\n")
+    print(f"{'mode':<14} {'stores':>10} {'durable':>10} {'transactions':>14}")
+    with tempfile.TemporaryDirectory() as directory:
+        for mode, write_through in (("write through", True), ("write behind", False)):
+            stored, durable, flushes = await measure(os.path.join(directory, f"{mode}.db"), vaults, writes, write_through)
+            print(f"{mode:<14} {stored * 1e3:>8.1f}ms {durable * 1e3:>8.1f}ms {flushes:>14}")
+
+if __name__ == "__main__":
+    asyncio.run(main())
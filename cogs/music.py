@@ -1,26 +1,56 @@
-from typing import Optional
+from typing import Dict, Optional, Set
+import asyncio
+import json
 from time import strftime
 from time import gmtime
 
 import discord
-from discord.ext import commands
+from discord.ext import commands, tasks
 from discord import app_commands
 from discord.ext.paginators.button_paginator import ButtonPaginator, PaginatorButton
 
 from libs.namumusic.ytdlpmusicplayer import YTDLPMusicPlayer
 from libs.namumusic.ytdlpaudio import PlaybackState, Metadata, YTDLPAudio
+from libs.namumusic.pcmcache import PCMCache, DEFAULT_MEMORY_BUDGET, DEFAULT_DISK_BUDGET
+from libs.namumusic.metadatacache import MetadataCache
+from libs.namumusic.metadatagetter import load_extractors
+from libs.namumusic.decodescheduler import DecodeScheduler, DEFAULT_WORKERS
+from libs.namumusic.metrics import get_default_metrics
+from libs.namumusic.queuesnapshot import QueueSnapshot, deserialize_song
+from libs.namumusic.dsp import DSPChain, BassBoost, Equalizer, Speed
+from libs.namumusic.thumbnailcolors import ThumbnailColors
 
 from libs.namuvaultmanager.vaultmanager import VaultManager
 
 import aiohttp
-from io import BytesIO
-from PIL import Image, ImageStat
+
+# thumbnails fetched right away when songs get queued, so a playlist doesnt download hundreds of them at once
+THUMBNAIL_PREFETCH = 5
 
 class music(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.vault_manager: VaultManager = self.bot.vault_manager
         self.guilds = {}
+        # shared between every guild so the same song only gets decoded once
+        self.pcm_cache = PCMCache(memory_budget=self.bot.config.get("music-cache-memory-budget", DEFAULT_MEMORY_BUDGET),
+                                  disk_budget=self.bot.config.get("music-cache-disk-budget", DEFAULT_DISK_BUDGET),
+                                  spill_directory=self.bot.config.get("music-cache-directory"))
+        self.metadata_cache = MetadataCache(self.bot.config.get("music-metadata-cache", "music.db"))
+        # shown on the web dashboard (see `Web`)
+        self.metrics = get_default_metrics()
+        # a fixed amount of decode threads no matter how many guilds are playing
+        self.decode_scheduler = DecodeScheduler(self.bot.config.get("music-decode-workers", DEFAULT_WORKERS), metrics=self.metrics)
+        # created in `cog_load` since it needs the event loop
+        self.http_session: Optional[aiohttp.ClientSession] = None
+        self.thumbnail_colors = ThumbnailColors(maxsize=self.bot.config.get("music-thumbnail-cache-size", 1024))
+        # queues get checkpointed into each guild's vault so they survive restarts
+        self.queue_snapshots: Dict[int, QueueSnapshot] = {}
+        self.saved_queue_versions: Dict[int, tuple] = {}
+        self.snapshot_guilds: Optional[Set[int]] = None
+        self.restored_queues = False
+        # the event loop only keeps weak references to tasks, so fire and forget ones are kept here until they finish
+        self.background_tasks: Set[asyncio.Task] = set()
         self.group.allowed_installs = discord.app_commands.AppInstallationType(guild=True, user=False)
 
     async def get_guild_player(self, voice_client: discord.VoiceClient):
@@ -29,7 +59,7 @@ class music(commands.Cog):
             return player
         else:
             vault = await self.vault_manager.get(voice_client.guild.id, "music")
-            player = YTDLPMusicPlayer(voice_client, on_finished=self.on_track_end, on_start=self.on_track_start)
+            player = YTDLPMusicPlayer(voice_client, on_finished=self.on_track_end, on_start=self.on_track_start, pcm_cache=self.pcm_cache, metadata_cache=self.metadata_cache, decode_scheduler=self.decode_scheduler, metrics=self.metrics.get_guild(voice_client.guild.id), http_session=self.http_session)
             player.crossfade = vault.get("crossfade", player.crossfade)
             player.crossfade_length = vault.get("crossfade_length", player.crossfade_length)
             player.crossfade_strength = vault.get("crossfade_strength", player.crossfade_strength)
@@ -41,11 +71,154 @@ class music(commands.Cog):
         if player:
             player.self_clean_up()
             self.guilds.pop(voice_client.guild.id)
+            self.metrics.remove_guild(voice_client.guild.id)
+            task = asyncio.get_running_loop().create_task(self.forget_queue(voice_client.guild.id))
+            self.background_tasks.add(task)
+            task.add_done_callback(self.background_tasks.discard)
 
     group = app_commands.Group(name="music", description="music stuff")
+
+    async def cog_load(self):
+        # build yt-dlp's extractor list in the background so the first `/music play` doesn't have to
+        asyncio.get_running_loop().run_in_executor(None, load_extractors)
+        self.http_session = aiohttp.ClientSession()
+        self.thumbnail_colors.http_session = self.http_session
+        self.checkpoint_queues.start()
+
+    async def cog_unload(self):
+        self.checkpoint_queues.cancel()
+        # snapshots still being forgotten would otherwise get cut off halfway
+        await asyncio.gather(*self.background_tasks, return_exceptions=True)
+        await self.save_queues()
+        if self.http_session:
+            await self.http_session.close()
+        # everything below outlives the cog otherwise, `!reload music` would leak decode threads,
+        # ffmpeg processes, decoded songs and spill files every time
+        for player in self.guilds.values():
+            player.self_clean_up()
+        self.guilds.clear()
+        self.decode_scheduler.stop()
+        loop = asyncio.get_running_loop()
+        # waits for the cache's own spilling to finish and deletes the spill files
+        await loop.run_in_executor(None, self.pcm_cache.clear)
+        # releasing the tracks stopped their ffmpeg processes, so the workers are only finishing their last slice
+        await loop.run_in_executor(None, self.decode_scheduler.join, 5.0)
+        await loop.run_in_executor(None, self.metadata_cache.close)
+
+    async def get_snapshot_guilds(self) -> Set[int]:
+        # the guilds that have a queue saved, kept in the bot's own music vault
+        if self.snapshot_guilds is None:
+            vault = await self.vault_manager.get("music")
+            self.snapshot_guilds = set(json.loads(vault.get("queue_guilds", "[]")))
+        return self.snapshot_guilds
+
+    async def set_snapshot_guild(self, guild_id: int, saved: bool) -> None:
+        snapshot_guilds = await self.get_snapshot_guilds()
+        if (guild_id in snapshot_guilds) == saved:
+            return
+        if saved:
+            snapshot_guilds.add(guild_id)
+        else:
+            snapshot_guilds.discard(guild_id)
+        vault = await self.vault_manager.get("music")
+        await vault.store("queue_guilds", json.dumps(sorted(snapshot_guilds)))
+
+    async def get_queue_snapshot(self, guild_id: int) -> QueueSnapshot:
+        snapshot = self.queue_snapshots.get(guild_id)
+        if not snapshot:
+            snapshot = QueueSnapshot(await self.vault_manager.get(guild_id, "music"))
+            self.queue_snapshots[guild_id] = snapshot
+        return snapshot
+
+    async def save_queue(self, guild_id: int, player: YTDLPMusicPlayer) -> None:
+        queue = player.queue
+        current = player.current_song
+        # while crossfading the previous song is still at the front of the queue
+        if current in queue:
+            queue = queue[queue.index(current):]
+        if not queue or not player.vc.is_connected():
+            await self.forget_queue(guild_id)
+            return
+
+        snapshot = await self.get_queue_snapshot(guild_id)
+        channel = player.extras.get("channel")
+        state = {"voice_channel": player.vc.channel.id,
+                 "text_channel": channel.id if channel else None,
+                 "position": current.get_position() if current else 0.0,
+                 "volume": player.volume}
+        version = (player.queue_version, id(current))
+        if self.saved_queue_versions.get(guild_id) == version:
+            await snapshot.save_state(state)
+        else:
+            await snapshot.save(queue, state)
+            self.saved_queue_versions[guild_id] = version
+        await self.set_snapshot_guild(guild_id, True)
+
+    async def forget_queue(self, guild_id: int) -> None:
+        if guild_id not in await self.get_snapshot_guilds():
+            return
+        snapshot = await self.get_queue_snapshot(guild_id)
+        if snapshot.state is None:
+            # so `clear` knows which batches there are
+            snapshot.load()
+        await snapshot.clear()
+        self.saved_queue_versions.pop(guild_id, None)
+        await self.set_snapshot_guild(guild_id, False)
+
+    async def save_queues(self) -> None:
+        for guild_id, player in list(self.guilds.items()):
+            try:
+                await self.save_queue(guild_id, player)
+            except Exception as e:
+                print(f"Failed To Save Music Queue Of {guild_id}: {e}")
+
+    @tasks.loop(seconds=10.0)
+    async def checkpoint_queues(self):
+        await self.save_queues()
+
+    async def restore_queue(self, guild_id: int) -> None:
+        snapshot = await self.get_queue_snapshot(guild_id)
+        state, entries = snapshot.load()
+        guild = self.bot.get_guild(guild_id)
+        channel = guild.get_channel(state["voice_channel"]) if guild and state else None
+        if not entries or not channel:
+            await self.forget_queue(guild_id)
+            return
+
+        vc = guild.voice_client or await channel.connect()
+        player = await self.get_guild_player(vc)
+        # voice channels have their own text chat, so that's where it goes if the text channel is gone
+        text_channel = guild.get_channel(state["text_channel"]) if state["text_channel"] else None
+        player.extras["channel"] = text_channel or channel
+        player.set_volume(state.get("volume", 1.0))
+        songs = [deserialize_song(entry) for entry in entries]
+        audios = await player.restore([(metadata, streamable) for metadata, streamable, _ in songs], state.get("position", 0.0))
+        for audio, (_, _, requester_id) in zip(audios, songs):
+            audio.extras["requester"] = (guild.get_member(requester_id) if requester_id else None) or self.bot.user
+        await player.play()
+        self.thumbnail_colors.prefetch(audio.metadata.thumbnail_url for audio in audios[:THUMBNAIL_PREFETCH])
+
+        metadata: Metadata = audios[0].metadata
+        embed = discord.Embed(description=f'## 🎵 Queue restored\nPicking up `{metadata.title} - {metadata.author}` where it left off with {len(audios)} song(s) in the queue.')
+        await player.extras["channel"].send(embed=embed)
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # on_ready fires again after every reconnect
+        if self.restored_queues:
+            return
+        self.restored_queues = True
+        for guild_id in list(await self.get_snapshot_guilds()):
+            try:
+                await self.restore_queue(guild_id)
+            except Exception as e:
+                print(f"Failed To Restore Music Queue Of {guild_id}: {e}")
     
     async def on_track_start(self, audio: YTDLPAudio, player: YTDLPMusicPlayer):
         metadata: Metadata = audio.metadata
+        # so the color is ready by the time someone asks what's playing
+        next_song = player.get_next_song()
+        self.thumbnail_colors.prefetch([metadata.thumbnail_url, next_song.metadata.thumbnail_url if next_song else None])
         match audio.playback_state:
             case PlaybackState.TRANSITIONING:
                 embed = discord.Embed(description=f'## 🎵 Playing now\nTrasitioning to playing `{metadata.title} - {metadata.author}` now.')
@@ -81,6 +254,8 @@ class music(commands.Cog):
             return await interaction.followup.send("You have to specify an audio source. ")
         for audio in audios:
             audio.extras["requester"] = interaction.user
+        # the rest of a playlist gets theirs once they get close to playing
+        self.thumbnail_colors.prefetch(audio.metadata.thumbnail_url for audio in audios[:THUMBNAIL_PREFETCH])
         metadata: Metadata = audios[0].metadata
         embed = discord.Embed(description=f'## 🎵 Song added to the queue.\n`{metadata.title} - {metadata.author}` was added to the queue.')
         await interaction.followup.send(embed=embed)
@@ -138,6 +313,24 @@ class music(commands.Cog):
         embed = discord.Embed(description=f"## Transition Set\nEnabled: {player.crossfade}\nDuration: {player.crossfade_length}\nStrength: {player.crossfade_strength}")
         await interaction.response.send_message(embed=embed)
 
+    @group.command(name="effects", description="bass boost, equalizer and speed (leave everything empty to turn them off)")
+    async def effects(self, interaction: discord.Interaction, bass_boost: Optional[float], low: Optional[float], mid: Optional[float], high: Optional[float], speed: Optional[float]):
+        vc = interaction.guild.voice_client
+        player = await self.get_guild_player(vc)
+        effects = []
+        # changes the pitch too, 1.25 is nightcore
+        if speed and speed != 1.0:
+            effects.append(Speed(speed))
+        if bass_boost:
+            effects.append(BassBoost(min(max(-12.0, bass_boost), 18.0)))
+        bands = [(frequency, min(max(-12.0, db), 12.0), 0.7) for frequency, db in ((250.0, low), (1500.0, mid), (8000.0, high)) if db]
+        if bands:
+            effects.append(Equalizer(bands))
+        chain = DSPChain(effects)
+        player.set_effects(chain)
+        embed = discord.Embed(description=f"## Effects Set\nBass Boost: {bass_boost or 0}dB\nLow: {low or 0}dB\nMid: {mid or 0}dB\nHigh: {high or 0}dB\nSpeed: {chain.rate}x")
+        await interaction.response.send_message(embed=embed)
+
     @group.command(name="skip", description="skip song")
     async def skip(self, interaction: discord.Interaction):
         vc = interaction.guild.voice_client
@@ -211,12 +404,9 @@ class music(commands.Cog):
 
         embed = discord.Embed(description=f'## [{metadata.title}]({metadata.url})\n-# by [{metadata.author}]({metadata.author_url})\n**{progressbar}**\n- {strftime("%H:%M:%S", gmtime(audio.get_position()))} - {strftime("%H:%M:%S", gmtime(metadata.length))}')
         if metadata.thumbnail_url:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(metadata.thumbnail_url) as response:
-                    thumbnail = await response.read()
-            artwork = Image.open(BytesIO(thumbnail))
-            median = ImageStat.Stat(artwork).median
-            embed.color=discord.Color.from_rgb(median[0], median[1], median[2])
+            color = await self.thumbnail_colors.get_color(metadata.thumbnail_url)
+            if color:
+                embed.color=discord.Color.from_rgb(*color)
             embed.set_image(url=metadata.thumbnail_url)
         embed.add_field(name="Requested by:", value=f'`{audio.extras.get("requester").name}`', inline=True)
         next_song = player.get_next_song()
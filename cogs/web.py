@@ -8,6 +8,7 @@ from aiohttp_session import get_session
 from jinja2 import Environment, FileSystemLoader
 
 from libs.namuvaultmanager.vaultmanager import VaultManager, Vault
+from libs.namumusic.metrics import get_default_metrics
 
 env = Environment(loader=FileSystemLoader('templates'))
 account_template = env.get_template('account.html')
@@ -58,6 +59,33 @@ class Web(commands.Cog):
             properties["servers"] = [{"icon": guild.icon.url if guild.icon else None, "id": guild.id, "name": guild.name} for guild in user.mutual_guilds]
             return web.Response(text=manage_template.render(properties), content_type='text/html')
 
+        @self.routes.get("/metrics/music")
+        async def music_metrics(request: web.Request):
+            session = await get_session(request)
+            id = session.get("id")
+            if not id:
+                return web.HTTPFound("/login/discord")
+            user: discord.User = await self.bot.fetch_user(id)
+            if not await self.bot.is_owner(user):
+                return web.HTTPForbidden()
+
+            snapshot = get_default_metrics().snapshot()
+            for guild_metrics in snapshot["guilds"]:
+                guild = self.bot.get_guild(guild_metrics["guild_id"])
+                guild_metrics["name"] = guild.name if guild else None
+            return web.json_response(snapshot)
+
+        @self.routes.get("/metrics/vault")
+        async def vault_metrics(request: web.Request):
+            session = await get_session(request)
+            id = session.get("id")
+            if not id:
+                return web.HTTPFound("/login/discord")
+            user: discord.User = await self.bot.fetch_user(id)
+            if not await self.bot.is_owner(user):
+                return web.HTTPForbidden()
+            return web.json_response(self.bot.vault_manager.get_pool_stats())
+
         @self.routes.get("/")
         async def root(request: web.Request):
             session = await get_session(request)
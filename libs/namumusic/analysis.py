@@ -0,0 +1,129 @@
+from dataclasses import dataclass
+from typing import Optional
+import math
+
+import numpy
+
+# the loudness envelope keeps one byte per 20ms frame: the frame's rms in `LEVEL_STEP` dB steps above `LEVEL_FLOOR` dBFS.
+# 0 means silence, a 3 minute song ends up at ~9KB which is small enough to keep around (and store) with every track
+LEVEL_STEP = 0.5
+LEVEL_FLOOR = -96.0
+MAX_LEVEL = 255
+
+# anything quieter than this is always silence, the same as the old rms > 500 check
+SILENCE_DB = -36.0
+# quiet songs (e.g. classical) get a lower threshold, relative to their own loudness but never below this
+MIN_SILENCE_DB = -60.0
+TRIM_RANGE = 30.0
+# a click or a breath in the silence isn't the start of the song, it has to stay above the threshold for 100ms
+MIN_LOUD_FRAMES = 5
+
+# gating roughly like EBU R128 (without the k-weighting) so quiet intros and fade outs don't pull the loudness down:
+# 400ms blocks with 75% overlap, blocks below -70dBFS and blocks 10dB below the ungated loudness are ignored
+BLOCK_FRAMES = 20
+BLOCK_HOP = 5
+ABSOLUTE_GATE_DB = -70.0
+RELATIVE_GATE_DB = -10.0
+
+# beats between 200 and 60 bpm, in frames
+MIN_BEAT_PERIOD = 15
+MAX_BEAT_PERIOD = 50
+# how strongly the onsets have to repeat at the beat period before it is trusted
+MIN_BEAT_STRENGTH = 0.1
+# how many beats before the crossfade get looked at to line it up, the period is only accurate to a frame
+# so looking at the whole song would drift
+BEAT_WINDOW = 8
+
+@dataclass
+class Analysis:
+    # integrated loudness as an rms value (same scale as `pcm.rms`)
+    loudness: float
+    # first and one past the last frame that isn't silence
+    start_index: int
+    end_index: int
+    # frames between two beats, None if the song has no clear beat
+    beat_period: Optional[int] = None
+
+def to_level(rms: float) -> int:
+    if rms <= 0:
+        return 0
+    level = round((20 * math.log10(rms / 32768) - LEVEL_FLOOR) / LEVEL_STEP)
+    return min(MAX_LEVEL, max(1, level))
+
+def to_db(levels: numpy.ndarray) -> numpy.ndarray:
+    return levels.astype(numpy.float32) * LEVEL_STEP + LEVEL_FLOOR
+
+def to_energy(levels: numpy.ndarray) -> numpy.ndarray:
+    # mean square of the samples, so averaging it is the same as averaging over the samples
+    energy = (32768 * 10 ** (to_db(levels).astype(numpy.float64) / 20)) ** 2
+    energy[levels == 0] = 0
+    return energy
+
+def get_loudness(levels: numpy.ndarray) -> float:
+    energy = to_energy(levels)
+    if not len(energy):
+        return 0.0
+    if len(energy) < BLOCK_FRAMES:
+        blocks = numpy.array([energy.mean()])
+    else:
+        total = numpy.concatenate(([0.0], numpy.cumsum(energy)))
+        starts = numpy.arange(0, len(energy) - BLOCK_FRAMES + 1, BLOCK_HOP)
+        blocks = (total[starts + BLOCK_FRAMES] - total[starts]) / BLOCK_FRAMES
+    blocks = blocks[blocks > (32768 * 10 ** (ABSOLUTE_GATE_DB / 20)) ** 2]
+    if not len(blocks):
+        return 0.0
+    blocks = blocks[blocks >= blocks.mean() * 10 ** (RELATIVE_GATE_DB / 10)]
+    return float(numpy.sqrt(blocks.mean()))
+
+def get_silence_level(loudness: float) -> int:
+    if loudness <= 0:
+        return to_level(32768 * 10 ** (SILENCE_DB / 20))
+    loudness_db = 20 * math.log10(loudness / 32768)
+    threshold = min(SILENCE_DB, max(MIN_SILENCE_DB, loudness_db - TRIM_RANGE))
+    return to_level(32768 * 10 ** (threshold / 20))
+
+def find_bounds(levels: numpy.ndarray, silence_level: int) -> tuple:
+    loud = (levels >= silence_level).astype(numpy.int32)
+    if not loud.any():
+        return 0, len(levels)
+    # start of every window of `MIN_LOUD_FRAMES` frames that are all loud
+    sustained = numpy.flatnonzero(numpy.convolve(loud, numpy.ones(MIN_LOUD_FRAMES, dtype=numpy.int32), "valid") == MIN_LOUD_FRAMES)
+    if len(sustained):
+        return int(sustained[0]), int(sustained[-1]) + MIN_LOUD_FRAMES
+    # nothing but short blips, the song is probably just very quiet
+    indexes = numpy.flatnonzero(loud)
+    return int(indexes[0]), int(indexes[-1]) + 1
+
+def get_onsets(levels: numpy.ndarray) -> numpy.ndarray:
+    # how much louder every frame got compared to the one before, beats show up as spikes in this
+    db = to_db(levels)
+    return numpy.maximum(numpy.diff(db, prepend=db[:1]), 0)
+
+def find_beat_period(levels: numpy.ndarray) -> Optional[int]:
+    onsets = get_onsets(levels)
+    if len(onsets) < MAX_BEAT_PERIOD * 4:
+        return None
+    onsets -= onsets.mean()
+    base = float(numpy.dot(onsets, onsets))
+    if base <= 0:
+        return None
+    correlation = [float(numpy.dot(onsets[:-lag], onsets[lag:])) / base for lag in range(MIN_BEAT_PERIOD, MAX_BEAT_PERIOD + 1)]
+    best = int(numpy.argmax(correlation))
+    if correlation[best] < MIN_BEAT_STRENGTH:
+        return None
+    return MIN_BEAT_PERIOD + best
+
+def find_last_beat(levels: numpy.ndarray, start: int, end: int, period: int) -> Optional[int]:
+    # the last frame before `end` that lines up with the beats in [start, end)
+    onsets = get_onsets(levels[start:end])
+    if len(onsets) < period * 2:
+        return None
+    phase = int(numpy.argmax(numpy.bincount(numpy.arange(len(onsets)) % period, weights=onsets, minlength=period)))
+    return start + phase + (len(onsets) - 1 - phase) // period * period
+
+def analyze(envelope: bytes) -> Analysis:
+    levels = numpy.frombuffer(envelope, dtype=numpy.uint8)
+    loudness = get_loudness(levels)
+    start_index, end_index = find_bounds(levels, get_silence_level(loudness))
+    return Analysis(loudness=loudness, start_index=start_index, end_index=end_index,
+                    beat_period=find_beat_period(levels[start_index:end_index]))
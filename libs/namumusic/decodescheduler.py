@@ -0,0 +1,151 @@
+from typing import List, Optional, Tuple
+import heapq
+import itertools
+import os
+import threading
+import time
+import traceback
+
+from libs.namumusic.pcmtrack import PCMTrack, DecodePriority, Status
+from libs.namumusic.metrics import MusicMetrics
+
+DEFAULT_WORKERS = min(4, os.cpu_count() or 1) + 1
+
+# one fixed set of decode threads shared by every `YTDLPAudio`.
+# once a track is decoded it stays in the queue until it is encoded to opus as well (see `PCMTrack.encode`).
+#
+# tracks get decoded in slices (see `PCMTrack.decode`) and go back into the queue after each slice,
+# so the most urgent track always gets the next free worker:
+# the currently playing tracks first, then the songs that are up next, then everything else being prefetched.
+# one worker is always kept free for playing tracks so prefetching can never starve them.
+class DecodeScheduler():
+    def __init__(self, workers: int = DEFAULT_WORKERS, metrics: Optional[MusicMetrics] = None):
+        self.workers = max(2, workers)
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.queue: List[Tuple[int, int, PCMTrack]] = []
+        self.counter = itertools.count()
+        self.threads: List[threading.Thread] = []
+        self.busy_background_workers = 0
+        self.stopping = False
+
+    def start_workers(self) -> None:
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self.run_worker, name=f"DecodeWorker-{len(self.threads)}", daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def submit(self, track: PCMTrack, priority: Optional[DecodePriority] = None) -> None:
+        if priority is not None:
+            track.priority = priority
+        with self.condition:
+            if self.stopping:
+                return
+            if not self.threads:
+                self.start_workers()
+            track.scheduled = True
+            heapq.heappush(self.queue, (track.priority, next(self.counter), track))
+            self.condition.notify()
+
+    def reprioritize(self, track: PCMTrack, priority: DecodePriority) -> None:
+        with self.condition:
+            track.priority = priority
+            for index, (_, counter, queued_track) in enumerate(self.queue):
+                if queued_track is track:
+                    self.queue[index] = (priority, counter, track)
+                    heapq.heapify(self.queue)
+                    break
+            else:
+                # decoded tracks leave the queue until someone is about to play them, then they get encoded
+                if not track.scheduled and not self.stopping and track.needs_encoding():
+                    if not self.threads:
+                        self.start_workers()
+                    track.scheduled = True
+                    heapq.heappush(self.queue, (priority, next(self.counter), track))
+            self.condition.notify_all()
+
+    def can_run(self, priority: int) -> bool:
+        if priority == DecodePriority.PLAYING:
+            return True
+        return self.busy_background_workers < self.workers - 1
+
+    def take(self) -> Optional[Tuple[PCMTrack, int]]:
+        with self.condition:
+            while not self.stopping and (not self.queue or not self.can_run(self.queue[0][0])):
+                self.condition.wait()
+            if self.stopping:
+                return None
+            priority, _, track = heapq.heappop(self.queue)
+            if priority != DecodePriority.PLAYING:
+                self.busy_background_workers += 1
+            return track, priority
+
+    def run_worker(self) -> None:
+        while (taken := self.take()):
+            track, priority = taken
+            decoding = track.status == Status.LOADING
+            frames = track.packets.decoded_frames if decoding else len(track.opus_packets or ())
+            restarts = track.restarts
+            start = time.perf_counter()
+            try:
+                if decoding:
+                    done = track.decode()
+                else:
+                    done = track.encode()
+            except Exception:
+                traceback.print_exc()
+                if track.status == Status.LOADING:
+                    track.stop()
+                    track.finish()
+                else:
+                    # the track itself is fine, it just doesn't get the opus fast path
+                    track.opus_packets = None
+                done = True
+            if self.metrics:
+                self.record_metrics(track, decoding, done, frames, restarts, time.perf_counter() - start)
+            with self.condition:
+                if priority != DecodePriority.PLAYING:
+                    self.busy_background_workers -= 1
+                    self.condition.notify_all()
+                # decided while holding the condition so `reprioritize` can't slip in between and get lost
+                if not self.stopping and ((not done and track.status == Status.LOADING) or track.needs_encoding()):
+                    heapq.heappush(self.queue, (track.priority, next(self.counter), track))
+                    self.condition.notify()
+                else:
+                    track.scheduled = False
+
+    def record_metrics(self, track: PCMTrack, decoding: bool, done: bool, frames: int, restarts: int, seconds: float) -> None:
+        # the counters go back to 0 if the track got released in the meantime
+        if decoding:
+            self.metrics.record_decode(max(0, track.packets.decoded_frames - frames), seconds, max(0, track.restarts - restarts))
+            if done:
+                self.metrics.record_track_done(track.status != Status.FINISHED)
+        else:
+            self.metrics.record_encode(max(0, len(track.opus_packets or ()) - frames), seconds)
+
+    def stop(self) -> None:
+        # the workers exit once they are done with their current slice, whatever is still queued gets dropped.
+        # the tracks themselves belong to `PCMCache`, releasing them stops their ffmpeg processes
+        with self.condition:
+            self.stopping = True
+            self.queue.clear()
+            self.condition.notify_all()
+
+    def join(self, timeout: Optional[float] = None) -> None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for thread in self.threads:
+            thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+
+    def get_queue_length(self) -> int:
+        with self.condition:
+            return len(self.queue)
+
+_default_scheduler: Optional[DecodeScheduler] = None
+_default_scheduler_lock = threading.Lock()
+
+def get_default_scheduler() -> DecodeScheduler:
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = DecodeScheduler()
+        return _default_scheduler
@@ -0,0 +1,130 @@
+from typing import List, Optional, Sequence, Tuple
+import math
+
+import numpy
+
+from libs.namumusic.resampler import MIN_RATE, MAX_RATE
+
+SAMPLE_RATE = 48000
+# every filter in a chain gets fused into a single fir filter that runs as one fft convolution per frame (overlap-save),
+# so a chain costs the same no matter how many effects are in it
+FFT_SIZE = 4096
+# has to fit into the fft together with a frame (at most FFT_SIZE - FRAME_LENGTH + 1), odd so the filter has linear phase.
+# delays the audio by ~21ms
+TAPS = 2049
+
+# effects don't process audio themselves, they only describe what they do to it
+# and `DSPChain` precomputes everything once when the chain gets built
+class Effect():
+    def get_gain(self) -> float:
+        # folded into the gain multiply every frame goes through anyway
+        return 1.0
+
+    def get_response(self, frequencies: numpy.ndarray) -> Optional[numpy.ndarray]:
+        # magnitude response at `frequencies` (hz), None if the effect doesn't filter
+        return None
+
+    def get_rate(self) -> float:
+        # playback rate, done by the song reading its pcm faster or slower (see `Resampler`)
+        return 1.0
+
+class Gain(Effect):
+    def __init__(self, db: float):
+        self.db = db
+
+    def get_gain(self) -> float:
+        return 10 ** (self.db / 20)
+
+class Speed(Effect):
+    # speed and pitch together, 1.25 is about nightcore
+    def __init__(self, rate: float):
+        self.rate = rate
+
+    def get_rate(self) -> float:
+        return self.rate
+
+def get_biquad_response(b: Tuple[float, float, float], a: Tuple[float, float, float], frequencies: numpy.ndarray) -> numpy.ndarray:
+    z = numpy.exp(-1j * 2 * numpy.pi * frequencies / SAMPLE_RATE)
+    return numpy.abs((b[0] + b[1] * z + b[2] * z**2) / (a[0] + a[1] * z + a[2] * z**2))
+
+def get_peaking_response(frequency: float, db: float, q: float, frequencies: numpy.ndarray) -> numpy.ndarray:
+    # from the audio eq cookbook
+    a = 10 ** (db / 40)
+    w0 = 2 * math.pi * frequency / SAMPLE_RATE
+    alpha = math.sin(w0) / (2 * q)
+    return get_biquad_response((1 + alpha * a, -2 * math.cos(w0), 1 - alpha * a),
+                               (1 + alpha / a, -2 * math.cos(w0), 1 - alpha / a), frequencies)
+
+def get_low_shelf_response(frequency: float, db: float, frequencies: numpy.ndarray) -> numpy.ndarray:
+    # from the audio eq cookbook, with a shelf slope of 1
+    a = 10 ** (db / 40)
+    w0 = 2 * math.pi * frequency / SAMPLE_RATE
+    cos = math.cos(w0)
+    alpha = math.sin(w0) / 2 * math.sqrt(2)
+    root = 2 * math.sqrt(a) * alpha
+    return get_biquad_response((a * ((a + 1) - (a - 1) * cos + root), 2 * a * ((a - 1) - (a + 1) * cos), a * ((a + 1) - (a - 1) * cos - root)),
+                               ((a + 1) + (a - 1) * cos + root, -2 * ((a - 1) + (a + 1) * cos), (a + 1) + (a - 1) * cos - root), frequencies)
+
+class Equalizer(Effect):
+    # one peaking filter per (frequency, gain in db, q) band
+    def __init__(self, bands: Sequence[Tuple[float, float, float]]):
+        self.bands = list(bands)
+
+    def get_response(self, frequencies: numpy.ndarray) -> Optional[numpy.ndarray]:
+        if not self.bands:
+            return None
+        response = numpy.ones(len(frequencies))
+        for frequency, db, q in self.bands:
+            response *= get_peaking_response(frequency, db, q, frequencies)
+        return response
+
+class BassBoost(Effect):
+    def __init__(self, db: float = 6.0, frequency: float = 120.0):
+        self.db = db
+        self.frequency = frequency
+
+    def get_response(self, frequencies: numpy.ndarray) -> Optional[numpy.ndarray]:
+        return get_low_shelf_response(self.frequency, self.db, frequencies)
+
+# the parameters of a set of effects, shared by every song of a player.
+# the filter state lives in the song (see `YTDLPAudio.apply_effects`) since every song needs its own
+class DSPChain():
+    def __init__(self, effects: Sequence[Effect] = ()):
+        self.effects: List[Effect] = list(effects)
+        self.gain = 1.0
+        self.rate = 1.0
+        response = None
+        frequencies = numpy.fft.rfftfreq(FFT_SIZE, 1 / SAMPLE_RATE)
+        for effect in self.effects:
+            self.gain *= effect.get_gain()
+            self.rate *= effect.get_rate()
+            effect_response = effect.get_response(frequencies)
+            if effect_response is not None:
+                response = effect_response if response is None else response * effect_response
+        self.rate = min(max(MIN_RATE, self.rate), MAX_RATE)
+        # the fft of the fused filter, None if there is nothing to filter
+        self.spectrum: Optional[numpy.ndarray] = None if response is None else self.design_filter(response)
+
+    def design_filter(self, response: numpy.ndarray) -> numpy.ndarray:
+        # frequency sampling: the zero phase impulse response gets centered, cut down to `TAPS` and windowed
+        impulse = numpy.roll(numpy.fft.irfft(response, FFT_SIZE), TAPS // 2)[:TAPS] * numpy.hanning(TAPS)
+        return numpy.fft.rfft(impulse, FFT_SIZE).astype(numpy.complex64)
+
+    def is_identity(self) -> bool:
+        return self.gain == 1.0 and self.rate == 1.0 and self.spectrum is None
+
+    def create_history(self) -> numpy.ndarray:
+        return numpy.zeros(FFT_SIZE, dtype=numpy.float32)
+
+    def process(self, samples: numpy.ndarray, history: numpy.ndarray) -> numpy.ndarray:
+        # filters the float32 `samples` in place, `history` holds the last `FFT_SIZE` input samples of the song.
+        # the gain isn't applied here, it's expected to be folded into however `samples` got scaled
+        if self.spectrum is None:
+            return samples
+        length = len(samples)
+        history[:-length] = history[length:]
+        history[-length:] = samples
+        spectrum = numpy.fft.rfft(history)
+        spectrum *= self.spectrum
+        samples[:] = numpy.fft.irfft(spectrum, FFT_SIZE)[-length:]
+        return samples
@@ -0,0 +1,197 @@
+from dataclasses import replace
+from datetime import datetime
+from typing import List, Optional
+from urllib.parse import urlparse, parse_qs, urlencode, urlunparse
+import sqlite3
+import threading
+import time
+
+from cachetools import LRUCache
+
+from libs.namumusic.metadata import Metadata
+from libs.namumusic.analysis import Analysis
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_SEARCH_TTL = 24 * 60 * 60
+DEFAULT_STREAM_URL_TTL = 60 * 60
+# stream urls get refreshed this long before they actually expire
+STREAM_URL_MARGIN = 5 * 60
+
+# query parameters that dont change what the url points to
+IGNORED_QUERY_PARAMETERS = ("si", "feature", "pp", "ab_channel", "start_radio", "t")
+
+def normalize_key(search: str) -> str:
+    search = search.strip()
+    url = urlparse(search)
+    if url.netloc == '':
+        # searches are case insensitive on youtube anyway
+        return "search:" + " ".join(search.casefold().split())
+
+    netloc = url.netloc.lower()
+    for prefix in ("www.", "m.", "music."):
+        if netloc.startswith(prefix):
+            netloc = netloc[len(prefix):]
+            break
+    path = url.path.rstrip("/")
+    query = parse_qs(url.query)
+    if netloc == "youtu.be":
+        netloc, query["v"], path = "youtube.com", [path.lstrip("/")], "/watch"
+    query = sorted((key, value) for key, values in query.items()
+                   if key not in IGNORED_QUERY_PARAMETERS and not key.startswith("utm_")
+                   for value in values)
+    return urlunparse(("https", netloc, path, "", urlencode(query), ""))
+
+def get_stream_url_expiry(stream_url: str) -> float:
+    # youtube (googlevideo) stream urls carry their expiry date with them
+    expire = parse_qs(urlparse(stream_url).query).get("expire")
+    if expire:
+        try:
+            return float(expire[0])
+        except ValueError:
+            pass
+    return time.time() + DEFAULT_STREAM_URL_TTL
+
+# persistent cache of `get_metadata` results so repeated songs don't go through yt-dlp again.
+# stream urls expire way sooner than the rest of the metadata, so they are kept in their own table
+# and get dropped (and later refreshed by `YTDLPAudio`) on their own.
+# the loudness analysis of every decoded song is kept here too so a song only ever gets analyzed once.
+class MetadataCache():
+    def __init__(self, database: str, ttl: float = DEFAULT_TTL, search_ttl: float = DEFAULT_SEARCH_TTL, memory_size: int = 1024):
+        self.db_connect_str = database
+        self.ttl = ttl
+        self.search_ttl = search_ttl
+
+        # `LRUCache` isn't thread-safe either, so the lock covers it as well as the connection
+        self.lock = threading.RLock()
+        self.db = self.connect_db()
+        self.create_tables(self.db)
+
+        # hot entries skip sqlite entirely
+        self.memory_cache: LRUCache = LRUCache(maxsize=memory_size)
+        self.stream_url_cache: LRUCache = LRUCache(maxsize=memory_size * 8)
+
+    def connect_db(self):
+        db = sqlite3.connect(self.db_connect_str, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def create_tables(self, connection):
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS metadata(
+                    key TEXT, position INTEGER, url TEXT, title TEXT, author TEXT, author_url TEXT,
+                    thumbnail_url TEXT, created_on REAL, length REAL, expires REAL,
+                    PRIMARY KEY (key, position))
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS stream_url(url TEXT PRIMARY KEY, stream_url TEXT, expires REAL)
+            """)
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS analysis(
+                    url TEXT PRIMARY KEY, loudness REAL, start_index INTEGER, end_index INTEGER, beat_period INTEGER, expires REAL)
+            """)
+
+    def db_get_metadata(self, key: str):
+        with self.lock:
+            return self.db.execute("""
+                SELECT url, title, author, author_url, thumbnail_url, created_on, length, expires
+                FROM metadata WHERE key = ? ORDER BY position
+            """, (key,)).fetchall()
+
+    def db_store_metadata(self, key: str, songs: List[Metadata], expires: float):
+        stream_urls = [(song.url, song.stream_url, get_stream_url_expiry(song.stream_url)) for song in songs if song.url and song.stream_url]
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM metadata WHERE key = ?", (key,))
+            self.db.executemany("""
+                INSERT INTO metadata (key, position, url, title, author, author_url, thumbnail_url, created_on, length, expires)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, [(key, position, song.url, song.title, song.author, song.author_url, song.thumbnail_url,
+                   song.created_on.timestamp() if song.created_on else None, song.length, expires)
+                  for position, song in enumerate(songs)])
+            self.db.executemany("INSERT OR REPLACE INTO stream_url (url, stream_url, expires) VALUES (?, ?, ?)", stream_urls)
+            for url, stream_url, expires in stream_urls:
+                self.stream_url_cache[url] = (stream_url, expires)
+
+    def get_stream_url(self, url: str) -> Optional[str]:
+        if not url:
+            return None
+        with self.lock:
+            row = self.stream_url_cache.get(url)
+            if row is None:
+                row = self.db.execute("SELECT stream_url, expires FROM stream_url WHERE url = ?", (url,)).fetchone()
+                if not row:
+                    return None
+                self.stream_url_cache[url] = row
+        if row[1] - STREAM_URL_MARGIN > time.time():
+            return row[0]
+        return None
+
+    def store_stream_url(self, url: str, stream_url: str) -> None:
+        if not url or not stream_url:
+            return
+        expires = get_stream_url_expiry(stream_url)
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO stream_url (url, stream_url, expires) VALUES (?, ?, ?)",
+                            (url, stream_url, expires))
+            self.stream_url_cache[url] = (stream_url, expires)
+
+    def get_analysis(self, url: str) -> Optional[Analysis]:
+        if not url:
+            return None
+        with self.lock:
+            row = self.db.execute("""
+                SELECT loudness, start_index, end_index, beat_period FROM analysis WHERE url = ? AND expires > ?
+            """, (url, time.time())).fetchone()
+        if not row:
+            return None
+        return Analysis(loudness=row[0], start_index=row[1], end_index=row[2], beat_period=row[3])
+
+    def store_analysis(self, url: str, analysis: Analysis) -> None:
+        if not url:
+            return
+        # the song itself doesn't change, this only expires so songs no one plays anymore get dropped
+        with self.lock, self.db:
+            self.db.execute("""
+                INSERT OR REPLACE INTO analysis (url, loudness, start_index, end_index, beat_period, expires) VALUES (?, ?, ?, ?, ?, ?)
+            """, (url, analysis.loudness, analysis.start_index, analysis.end_index, analysis.beat_period, time.time() + self.ttl))
+
+    def get(self, search: str) -> Optional[List[Metadata]]:
+        key = normalize_key(search)
+        now = time.time()
+        with self.lock:
+            entry = self.memory_cache.get(key)
+            if entry is None or entry[0] <= now:
+                rows = self.db_get_metadata(key)
+                if not rows or rows[0][7] <= now:
+                    self.memory_cache.pop(key, None)
+                    return None
+                songs = [Metadata(url=url, title=title, author=author, author_url=author_url, thumbnail_url=thumbnail_url,
+                                  created_on=datetime.fromtimestamp(created_on) if created_on is not None else None, length=length)
+                         for url, title, author, author_url, thumbnail_url, created_on, length, _ in rows]
+                entry = (rows[0][7], songs)
+                self.memory_cache[key] = entry
+        # the metadata gets modified by `YTDLPAudio` so everyone gets their own copy.
+        # the stream url only gets filled in if it is still valid, else it gets fetched again when the song starts loading
+        return [replace(song, stream_url=self.get_stream_url(song.url)) for song in entry[1]]
+
+    def store(self, search: str, songs: List[Metadata]) -> None:
+        if not songs:
+            return
+        key = normalize_key(search)
+        expires = time.time() + (self.search_ttl if key.startswith("search:") else self.ttl)
+        with self.lock:
+            self.db_store_metadata(key, songs, expires)
+            self.memory_cache[key] = (expires, [replace(song, stream_url=None) for song in songs])
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+    def clean_up(self) -> None:
+        now = time.time()
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM metadata WHERE expires <= ?", (now,))
+            self.db.execute("DELETE FROM stream_url WHERE expires <= ?", (now,))
+            self.db.execute("DELETE FROM analysis WHERE expires <= ?", (now,))
+            self.memory_cache.clear()
+            self.stream_url_cache.clear()
@@ -1,10 +1,60 @@
 import yt_dlp
-from typing import List
+from yt_dlp.extractor.common import InfoExtractor
+import threading
+from typing import Dict, List, Optional, Type
 from urllib.parse import urlparse
 from libs.namumusic.metadata import Metadata
+from libs.namumusic.metadatacache import MetadataCache
 from datetime import datetime
 from sclib import SoundcloudAPI, Track, Playlist
 
+# yt-dlp has over a thousand extractors, checking every single one of them for each url is slow.
+# the list only gets built once, and every host remembers which extractors matched on it before
+# so only urls from a host we haven't seen yet go through the full list.
+_extractors: Optional[List[Type[InfoExtractor]]] = None
+_host_extractors: Dict[str, List[Type[InfoExtractor]]] = {}
+_extractors_lock = threading.Lock()
+
+def load_extractors() -> List[Type[InfoExtractor]]:
+    global _extractors
+    if _extractors is None:
+        with _extractors_lock:
+            if _extractors is None:
+                _extractors = [e for e in yt_dlp.extractor.gen_extractor_classes() if e.IE_NAME != 'generic']
+    return _extractors
+
+def get_extractor_family(ie_name: str) -> str:
+    # "youtube:tab" -> "youtube"
+    return ie_name.split(":")[0].lower()
+
+def find_extractor(url: str, extractors: List[Type[InfoExtractor]]) -> Optional[Type[InfoExtractor]]:
+    # the last suitable extractor wins, same as yt-dlp's own ordering
+    found = None
+    for e in extractors:
+        if e.suitable(url):
+            found = e
+    return found
+
+def get_extractor(url: str) -> str:
+    host = urlparse(url).netloc.lower()
+    candidates = _host_extractors.get(host)
+    if candidates:
+        extractor = find_extractor(url, candidates)
+        if extractor:
+            return get_extractor_family(extractor.IE_NAME)
+
+    extractors = load_extractors()
+    extractor = find_extractor(url, extractors)
+    if not extractor:
+        return ""
+    with _extractors_lock:
+        candidates = _host_extractors.setdefault(host, [])
+        if extractor not in candidates:
+            candidates.append(extractor)
+            # keep the same order as the full list so `find_extractor` picks the same one
+            candidates.sort(key=extractors.index)
+    return get_extractor_family(extractor.IE_NAME)
+
 def parse_from_soundcloud_api(track: Track):
     metadata = Metadata()
 
@@ -42,7 +92,12 @@ def parse_from_ytdlp_dict(ytdlp_dict: dict, add_stream_url: bool = True):
 
     return metadata
 
-def get_metadata(search: str) -> List[Metadata]:
+def get_metadata(search: str, metadata_cache: Optional[MetadataCache] = None) -> List[Metadata]:
+    if metadata_cache:
+        songs = metadata_cache.get(search)
+        if songs:
+            return songs
+
     raw_songs=[]
     songs=[]
     url=None
@@ -58,11 +113,7 @@ def get_metadata(search: str) -> List[Metadata]:
     
     extractor=""
     if url:
-        extractors = yt_dlp.extractor.gen_extractors()
-        for e in extractors:
-            if e.suitable(url) and e.IE_NAME != 'generic':
-                extractor = (e.IE_NAME+" ")[:e.IE_NAME.find(":")]
-        extractor = extractor.lower()
+        extractor = get_extractor(url)
     
     match extractor:
         # normal
@@ -86,4 +137,7 @@ def get_metadata(search: str) -> List[Metadata]:
 
     for song in raw_songs:
         songs.append(parse_from_ytdlp_dict(song, extractor not in ("bandcamp",)))
+
+    if metadata_cache:
+        metadata_cache.store(search, songs)
     return songs
@@ -0,0 +1,171 @@
+from typing import Dict, List, Optional
+import bisect
+import threading
+import time
+
+# upper bounds (in milliseconds) of the latency histogram buckets, anything slower goes into the last one.
+# a frame is 20ms, so anything above that is a frame discord.py had to wait for
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 50.0)
+
+# these get updated from the audio thread on every frame, so recording is just a few integer additions.
+# nothing here takes a lock on the audio thread, a snapshot taken mid-update can be off by a frame which is fine for metrics
+class Histogram():
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def get_percentile(self, percentile: float) -> float:
+        # only as precise as the buckets, returns the upper bound of the bucket the percentile falls into
+        if not self.count:
+            return 0.0
+        target = self.count * percentile
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.buckets[index] if index < len(self.buckets) else self.max
+        return self.max
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "p50": self.get_percentile(0.5),
+            "p99": self.get_percentile(0.99),
+            "max": self.max,
+            "buckets": dict(zip([str(bucket) for bucket in self.buckets] + ["inf"], self.counts)),
+        }
+
+class GuildMetrics():
+    def __init__(self, guild_id: int):
+        self.guild_id = guild_id
+        # how long `Mixer.read` takes, this includes reading every source
+        self.read_latency = Histogram()
+        # how long a single song takes to produce its frame (gain, effects, ...)
+        self.source_latency = Histogram()
+        # time between two `Mixer.read` calls, if this goes way over 20ms the voice thread itself is falling behind
+        self.read_interval = Histogram(tuple(bucket + 20.0 for bucket in LATENCY_BUCKETS))
+        self.last_read: Optional[int] = None
+
+        self.frames = 0
+        self.opus_frames = 0
+        self.underruns = 0
+        # decoded frames ahead of the playback position of the current song
+        self.buffer_depth = 0
+        self.min_buffer_depth: Optional[int] = None
+
+    def record_read(self, start: int, end: int) -> None:
+        self.read_latency.record((end - start) / 1e6)
+        if self.last_read is not None:
+            self.read_interval.record((start - self.last_read) / 1e6)
+        self.last_read = start
+        self.frames += 1
+
+    def record_source_read(self, duration: int, buffer_depth: int, is_opus: bool = False) -> None:
+        self.source_latency.record(duration / 1e6)
+        self.buffer_depth = buffer_depth
+        if self.min_buffer_depth is None or buffer_depth < self.min_buffer_depth:
+            self.min_buffer_depth = buffer_depth
+        if is_opus:
+            self.opus_frames += 1
+
+    def record_underrun(self) -> None:
+        self.underruns += 1
+        self.buffer_depth = 0
+        self.min_buffer_depth = 0
+
+    def snapshot(self) -> dict:
+        return {
+            "guild_id": self.guild_id,
+            "frames": self.frames,
+            "opus_frames": self.opus_frames,
+            "underruns": self.underruns,
+            "buffer_depth": self.buffer_depth,
+            "min_buffer_depth": self.min_buffer_depth,
+            "read_latency": self.read_latency.snapshot(),
+            "source_latency": self.source_latency.snapshot(),
+            "read_interval": self.read_interval.snapshot(),
+        }
+
+class MusicMetrics():
+    def __init__(self):
+        self.started = time.monotonic()
+        self.guilds: Dict[int, GuildMetrics] = {}
+        # the decode side gets updated by several decode workers at once, so unlike the guild metrics it needs the lock
+        self.lock = threading.Lock()
+        self.decoded_frames = 0
+        self.decode_seconds = 0.0
+        self.encoded_frames = 0
+        self.encode_seconds = 0.0
+        self.ffmpeg_restarts = 0
+        self.tracks_finished = 0
+        self.tracks_failed = 0
+
+    def get_guild(self, guild_id: int) -> GuildMetrics:
+        with self.lock:
+            guild = self.guilds.get(guild_id)
+            if not guild:
+                guild = self.guilds[guild_id] = GuildMetrics(guild_id)
+            return guild
+
+    def remove_guild(self, guild_id: int) -> None:
+        with self.lock:
+            self.guilds.pop(guild_id, None)
+
+    def record_decode(self, frames: int, seconds: float, restarts: int = 0) -> None:
+        with self.lock:
+            self.decoded_frames += frames
+            self.decode_seconds += seconds
+            self.ffmpeg_restarts += restarts
+
+    def record_encode(self, frames: int, seconds: float) -> None:
+        with self.lock:
+            self.encoded_frames += frames
+            self.encode_seconds += seconds
+
+    def record_track_done(self, failed: bool) -> None:
+        with self.lock:
+            if failed:
+                self.tracks_failed += 1
+            else:
+                self.tracks_finished += 1
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            guilds: List[GuildMetrics] = list(self.guilds.values())
+            decode = {
+                "decoded_frames": self.decoded_frames,
+                "decode_seconds": self.decode_seconds,
+                # how many times faster than realtime the workers decode while they are busy
+                "decode_speed": self.decoded_frames * 0.02 / self.decode_seconds if self.decode_seconds else 0.0,
+                "encoded_frames": self.encoded_frames,
+                "encode_seconds": self.encode_seconds,
+                "ffmpeg_restarts": self.ffmpeg_restarts,
+                "tracks_finished": self.tracks_finished,
+                "tracks_failed": self.tracks_failed,
+            }
+        return {
+            "uptime": time.monotonic() - self.started,
+            "decode": decode,
+            "guilds": [guild.snapshot() for guild in guilds],
+        }
+
+_default_metrics: Optional[MusicMetrics] = None
+_default_metrics_lock = threading.Lock()
+
+def get_default_metrics() -> MusicMetrics:
+    global _default_metrics
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = MusicMetrics()
+        return _default_metrics
@@ -1,10 +1,29 @@
+from typing import Optional
+import time
+
 import discord
-import struct
+import numpy
+
+from libs.namumusic import pcm
+from libs.namumusic.metrics import GuildMetrics
+
+FRAME_SIZE = pcm.STEREO_FRAME_SIZE
+FRAME_SAMPLES = FRAME_SIZE // 2
 
 class Mixer(discord.AudioSource):
     def __init__(self):
         self.channels = {}
-        self._mixed_buffer = bytearray(3840)
+        self.channel_gains = {}
+
+        # preallocated so mixing doesnt allocate on the audio thread
+        self._accumulator = numpy.zeros(FRAME_SAMPLES, dtype=numpy.int32)
+        self._channel_accumulator = numpy.zeros(FRAME_SAMPLES, dtype=numpy.int32)
+        self._gain_buffer = numpy.zeros(FRAME_SAMPLES, dtype=numpy.float32)
+        self._mixed_buffer = numpy.zeros(FRAME_SAMPLES, dtype=numpy.int16)
+
+        # whether the last frame returned by `read` was already opus encoded
+        self._is_opus = False
+        self.metrics: Optional[GuildMetrics] = None
 
     def get_channel(self, channel_str: str):
         channel = self.channels.get(channel_str)
@@ -15,6 +34,12 @@ class Mixer(discord.AudioSource):
         self.channels[channel_str] = channel
         return channel
 
+    def set_channel_gain(self, channel_str: str, gain: float) -> None:
+        self.channel_gains[channel_str] = gain
+
+    def get_channel_gain(self, channel_str: str) -> float:
+        return self.channel_gains.get(channel_str, 1.0)
+
     def add_audio_source(self, channel_str: str, audio: discord.AudioSource) -> None:
         channel = self.get_channel(channel_str)
         try:
@@ -29,53 +54,105 @@ class Mixer(discord.AudioSource):
         except Exception as e:
             print(f"Mixer {id(self)} Exception While Removing: {e}")
 
-    def mix_pcm_16bit(self, pcm1: bytes, pcm2: bytes) -> bytes:
-        for i in range(0, 3840, 2):  # Step by 2 because it's 16-bit (2 bytes per sample)
-            # Unpack 16-bit samples (little-endian, signed)
-            sample1 = struct.unpack_from("<h", pcm1, i)[0]
-            sample2 = struct.unpack_from("<h", pcm2, i)[0]
-
-            # Mix the samples (prevent overflow by keeping within int16 range)
-            mixed_sample = max(min(sample1 + sample2, 32767), -32768)
+    def apply_gain(self, accumulator: numpy.ndarray, gain: float) -> None:
+        numpy.multiply(accumulator, gain, out=self._gain_buffer, casting="unsafe")
+        numpy.rint(self._gain_buffer, out=self._gain_buffer)
+        numpy.copyto(accumulator, self._gain_buffer, casting="unsafe")
 
-            # Pack back into little-endian bytes using pre-allocated buffer
-            struct.pack_into("<h", self._mixed_buffer, i, mixed_sample)
+    def mix_pcm_16bit(self, *pcms: bytes) -> bytes:
+        self._accumulator.fill(0)
+        for pcm_frame in pcms:
+            pcm.accumulate(self._accumulator, pcm_frame)
+        return pcm.saturate(self._accumulator, self._mixed_buffer).tobytes()
 
-        return bytes(self._mixed_buffer)
+    def read_source(self, audio_source: discord.AudioSource, allow_opus: bool = False):
+        # a single source that doesn't need to be mixed can hand over an already encoded opus frame,
+        # if it doesn't have one it gives back a mono frame instead
+        if allow_opus:
+            read_opus = getattr(audio_source, "read_opus", None)
+            if read_opus:
+                packet, is_opus = read_opus()
+                return packet, not is_opus, is_opus
+        # sources that can give us mono frames skip their own stereo conversion,
+        # the mono frame gets spread to both channels while accumulating instead
+        read_mono = getattr(audio_source, "read_mono", None)
+        if read_mono:
+            return read_mono(), True, False
+        return audio_source.read(), False, False
 
     def read(self):
+        metrics = self.metrics
+        if not metrics:
+            return self.mix()
+        start = time.perf_counter_ns()
+        output = self.mix()
+        metrics.record_read(start, time.perf_counter_ns())
+        return output
+
+    def mix(self):
         output = None
+        output_is_mono = False
+        sources_mixed = 0
         channels_to_remove = []
-        
+        self._accumulator.fill(0)
+        self._is_opus = False
+        single_source = sum(len(channel) for channel in self.channels.values()) == 1
+
         for channel_name, channel in list(self.channels.items()):
+            channel_output = None
+            channel_sources_mixed = 0
+            allow_opus = single_source and self.get_channel_gain(channel_name) == 1.0
+            self._channel_accumulator.fill(0)
             for audio_source_index in range(len(channel) - 1, -1, -1):
                 audio_source = channel[audio_source_index]
-                audio_source_output = audio_source.read()
+                audio_source_output, is_mono, is_opus = self.read_source(audio_source, allow_opus)
+                if is_opus and audio_source_output:
+                    self._is_opus = True
+                    return audio_source_output
                 if audio_source_output == b'':
                     try:
                         del channel[audio_source_index]
                     except Exception as e:
                         print(f"Mixer {id(self)} Exception While Removing From Channel: {e}")
                     continue
-                if output:
-                    output = self.mix_pcm_16bit(output, audio_source_output)
-                else:
-                    output = audio_source_output
-            
+                if not audio_source_output:
+                    continue
+                channel_output = audio_source_output
+                output_is_mono = is_mono
+                channel_sources_mixed += 1
+                pcm.accumulate(self._channel_accumulator, audio_source_output, is_mono)
+
+            if channel_sources_mixed:
+                gain = self.get_channel_gain(channel_name)
+                if gain != 1.0:
+                    self.apply_gain(self._channel_accumulator, gain)
+                    channel_output = None
+                elif channel_sources_mixed > 1:
+                    channel_output = None
+                numpy.add(self._accumulator, self._channel_accumulator, out=self._accumulator)
+                sources_mixed += channel_sources_mixed
+                output = channel_output
+
             if not channel:
                 channels_to_remove.append(channel_name)
-        
+
         for channel_name in channels_to_remove:
             del self.channels[channel_name]
-        
-        if not output:
-            output = b"\x00" * 3840
-        return output
-    
+
+        # a single untouched source can be passed through without mixing
+        if sources_mixed == 1 and output:
+            if output_is_mono:
+                return pcm.to_stereo(output, self._mixed_buffer).tobytes()
+            return output
+        if not sources_mixed:
+            return pcm.STEREO_SILENCE
+        return pcm.saturate(self._accumulator, self._mixed_buffer).tobytes()
+
     def is_opus(self):
-        return False
-    
+        # discord.py checks this for every frame right after `read`
+        return self._is_opus
+
     def clear_channels(self) -> None:
         for channel in self.channels.values():
             channel.clear()
-        self.channels.clear()
\ No newline at end of file
+        self.channels.clear()
@@ -0,0 +1,22 @@
+from typing import Optional
+
+from discord import opus
+
+from libs.namumusic import pcm
+
+# has to match what the player asks the voice client for,
+# pre-encoded frames get sent as is so they should sound the same as the ones discord.py encodes itself
+BITRATE = 512
+SIGNAL_TYPE = "music"
+
+def create_encoder() -> Optional[opus.Encoder]:
+    try:
+        return opus.Encoder(bitrate=BITRATE, signal_type=SIGNAL_TYPE)
+    except opus.OpusNotLoaded:
+        return None
+    except Exception as e:
+        print(f"Failed To Create Opus Encoder: {e}")
+        return None
+
+def encode(encoder: opus.Encoder, stereo_pcm: bytes) -> bytes:
+    return encoder.encode(stereo_pcm, pcm.FRAME_LENGTH)
@@ -0,0 +1,58 @@
+import numpy
+
+# 16-bit 48khz pcm, one frame is 20ms
+SAMPLE_WIDTH = 2
+FRAME_LENGTH = 960
+MONO_FRAME_SIZE = FRAME_LENGTH * SAMPLE_WIDTH
+STEREO_FRAME_SIZE = FRAME_LENGTH * SAMPLE_WIDTH * 2
+
+MONO_SILENCE = b"\x00" * MONO_FRAME_SIZE
+STEREO_SILENCE = b"\x00" * STEREO_FRAME_SIZE
+
+# small numpy kernels that replace `audioop` (removed in python 3.13).
+# everything that runs per frame takes a preallocated `out` buffer so the audio thread doesn't allocate.
+
+def as_samples(pcm: bytes) -> numpy.ndarray:
+    return numpy.frombuffer(pcm, dtype=numpy.int16)
+
+def rms(pcm: bytes) -> int:
+    samples = as_samples(pcm)
+    if not len(samples):
+        return 0
+    return int(numpy.sqrt(numpy.square(samples, dtype=numpy.float64).mean()))
+
+def to_stereo(pcm: bytes, out: numpy.ndarray) -> numpy.ndarray:
+    # out has to be an int16 buffer twice the length of the mono frame
+    out.reshape(-1, 2)[:] = as_samples(pcm)[:, None]
+    return out
+
+def scale(pcm: bytes, gain: float, out: numpy.ndarray) -> numpy.ndarray:
+    # out is a float32 buffer the length of the frame
+    numpy.multiply(as_samples(pcm), gain, out=out)
+    return out
+
+def quantize(work: numpy.ndarray, out: numpy.ndarray) -> numpy.ndarray:
+    # back from float32 into the int16 `out`, clipping instead of wrapping around. `work` gets clipped in place
+    numpy.clip(work, -32768, 32767, out=work)
+    numpy.copyto(out, work, casting="unsafe")
+    return out
+
+def apply_gain(pcm: bytes, gain: float, work: numpy.ndarray, out: numpy.ndarray) -> numpy.ndarray:
+    # work is a float32 buffer and out an int16 buffer, both the length of the frame
+    return quantize(scale(pcm, gain, work), out)
+
+def accumulate(accumulator: numpy.ndarray, pcm: bytes, mono: bool = False) -> None:
+    # accumulator is an int32 stereo buffer, int32 has plenty of headroom for summing int16 so this can never wrap around.
+    # mono frames get broadcast to both channels while being added, so they never need a separate stereo conversion.
+    samples = as_samples(pcm)
+    if mono:
+        stereo = accumulator.reshape(-1, 2)
+        numpy.add(stereo, samples[:, None], out=stereo, casting="unsafe")
+    else:
+        numpy.add(accumulator, samples, out=accumulator, casting="unsafe")
+
+def saturate(accumulator: numpy.ndarray, out: numpy.ndarray) -> numpy.ndarray:
+    # clip back into the int16 range instead of wrapping
+    numpy.clip(accumulator, -32768, 32767, out=accumulator)
+    numpy.copyto(out, accumulator, casting="unsafe")
+    return out
@@ -0,0 +1,170 @@
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+import threading
+import traceback
+
+from libs.namumusic.pcmtrack import PCMTrack, Status
+
+DEFAULT_MEMORY_BUDGET = 512 * 1024 * 1024
+DEFAULT_DISK_BUDGET = 4 * 1024 * 1024 * 1024
+
+# process-wide cache of decoded songs shared by every guild player.
+# - the same key (song url) always resolves to the same `PCMTrack` so ffmpeg only runs once per song
+# - once the decoded pcm and opus frames held in memory go over `memory_budget`, the opus frames of
+#   songs no one is playing get dropped and then the least recently played decoded tracks get spilled
+#   to memory-mapped files. if that still isn't enough the songs being played lose their opus frames too
+# - once the spilled tracks go over `disk_budget`, the least recently played unused tracks get evicted
+class PCMCache():
+    def __init__(self, memory_budget: int = DEFAULT_MEMORY_BUDGET, disk_budget: int = DEFAULT_DISK_BUDGET, spill_directory: Optional[str] = None):
+        self.memory_budget = memory_budget
+        self.disk_budget = disk_budget
+        self.spill_directory = spill_directory
+
+        # ordered from least to most recently played
+        self.tracks: OrderedDict[str, PCMTrack] = OrderedDict()
+        self.lock = threading.Lock()
+        # `release` gets called from discord.py's audio thread, so freeing and spilling tracks happens on here instead
+        self.maintenance: Optional[ThreadPoolExecutor] = None
+        self.budget_pending = False
+
+    def acquire(self, key: Optional[str]) -> PCMTrack:
+        if not key:
+            track = PCMTrack()
+            track.users += 1
+            return track
+        with self.lock:
+            track = self.tracks.get(key)
+            if not track or track.status == Status.FAILED:
+                track = PCMTrack(key)
+                track.on_decoded = self.on_track_decoded
+                self.tracks[key] = track
+            self.tracks.move_to_end(key)
+            track.users += 1
+        return track
+
+    def release(self, track: PCMTrack) -> None:
+        with self.lock:
+            track.users -= 1
+            if track.users > 0:
+                return
+            # a partially decoded track can't be reused, so theres no point in keeping it around
+            if track.status != Status.FINISHED:
+                if self.tracks.get(track.key) is track:
+                    del self.tracks[track.key]
+                evict = True
+            else:
+                evict = False
+                # nothing is playing it now, so whoever plays it next can have opus frames again
+                track.restore_opus()
+        if evict:
+            self.run_maintenance(track.release)
+        self.schedule_budget()
+
+    def run_maintenance(self, function, *args) -> None:
+        with self.lock:
+            if not self.maintenance:
+                self.maintenance = ThreadPoolExecutor(max_workers=1, thread_name_prefix="PCMCache")
+            self.maintenance.submit(self.run_safely, function, *args)
+
+    def run_safely(self, function, *args) -> None:
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def schedule_budget(self) -> None:
+        # a bunch of songs ending at once only needs one pass
+        with self.lock:
+            if self.budget_pending:
+                return
+            self.budget_pending = True
+        self.run_maintenance(self.run_budget)
+
+    def run_budget(self) -> None:
+        with self.lock:
+            self.budget_pending = False
+        self.enforce_budget()
+
+    def touch(self, track: PCMTrack) -> None:
+        track.touch()
+        with self.lock:
+            if self.tracks.get(track.key) is track:
+                self.tracks.move_to_end(track.key)
+
+    def on_track_decoded(self, track: PCMTrack) -> None:
+        try:
+            self.enforce_budget()
+        except Exception:
+            traceback.print_exc()
+
+    def get_memory_usage(self) -> int:
+        with self.lock:
+            return sum(track.packets.memory_nbytes + track.opus_nbytes for track in self.tracks.values())
+
+    def get_disk_usage(self) -> int:
+        with self.lock:
+            return sum(track.packets.nbytes for track in self.tracks.values() if track.packets.spilled)
+
+    def enforce_budget(self) -> None:
+        to_spill = []
+        to_evict = []
+        to_drop = []
+        with self.lock:
+            memory_usage = sum(track.packets.memory_nbytes + track.opus_nbytes for track in self.tracks.values())
+            disk_usage = sum(track.packets.nbytes for track in self.tracks.values() if track.packets.spilled)
+
+            # opus frames can't be spilled, but they are cheap to encode again if the song comes back
+            for track in self.tracks.values():
+                if memory_usage <= self.memory_budget:
+                    break
+                if not track.users and track.opus_nbytes:
+                    to_drop.append((track, True))
+                    memory_usage -= track.opus_nbytes
+
+            for key, track in self.tracks.items():
+                if memory_usage <= self.memory_budget:
+                    break
+                # tracks that are still decoding get appended to, so they have to stay in memory
+                if track.status == Status.FINISHED and not track.packets.spilled:
+                    to_spill.append(track)
+                    memory_usage -= track.packets.nbytes
+                    disk_usage += track.packets.nbytes
+
+            # discord.py encodes those songs itself from here on
+            for track in self.tracks.values():
+                if memory_usage <= self.memory_budget:
+                    break
+                if track.users and track.opus_nbytes:
+                    to_drop.append((track, False))
+                    memory_usage -= track.opus_nbytes
+
+            for key, track in list(self.tracks.items()):
+                if disk_usage <= self.disk_budget:
+                    break
+                if not track.users and (track.packets.spilled or track in to_spill):
+                    to_evict.append(track)
+                    disk_usage -= track.packets.nbytes
+                    del self.tracks[key]
+
+        # the actual io happens outside of the lock so `acquire` doesn't get blocked by it
+        for track, reencode in to_drop:
+            track.drop_opus(reencode)
+        for track in to_evict:
+            track.release()
+        for track in to_spill:
+            if track not in to_evict:
+                with track.lock:
+                    track.packets.spill(self.spill_directory)
+
+    def clear(self) -> None:
+        with self.lock:
+            tracks = list(self.tracks.values())
+            self.tracks.clear()
+            maintenance = self.maintenance
+            self.maintenance = None
+        # whatever was still being freed or spilled finishes first
+        if maintenance:
+            maintenance.shutdown(wait=True)
+        for track in tracks:
+            track.release()
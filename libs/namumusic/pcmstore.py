@@ -0,0 +1,165 @@
+from typing import Dict, List, Optional, Union
+import bisect
+import mmap
+import tempfile
+
+from libs.namumusic.pcm import MONO_FRAME_SIZE
+
+FRAMES_PER_CHUNK = 500 # 10 seconds per chunk
+
+class PCMStore():
+    # frames are packed back to back into fixed size chunks instead of one `bytes` object per frame.
+    # chunks are never resized once allocated, so the memoryviews handed out by `__getitem__`
+    # stay valid (and zero-copy) while the decoder keeps writing to the store.
+    #
+    # the store can be sparse, the decoder can jump around with `seek` (e.g. when the user seeks far ahead)
+    # and `segments` keeps track of which ranges of frames have actually been decoded.
+    def __init__(self, frame_size: int = MONO_FRAME_SIZE, frames_per_chunk: int = FRAMES_PER_CHUNK):
+        self.frame_size = frame_size
+        self.frames_per_chunk = frames_per_chunk
+        self.chunk_size = frame_size * frames_per_chunk
+
+        self.chunks: Dict[int, Union[bytearray, memoryview]] = {}
+        # one past the furthest decoded frame
+        self.length = 0
+        # sorted and non-overlapping [start, end) ranges of decoded frames
+        self.segments: List[List[int]] = []
+        self.decoded_frames = 0
+        self.write_index = 0
+
+        self.spill_map: Optional[mmap.mmap] = None
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> memoryview:
+        if index < 0:
+            index += self.length
+        if not self.is_decoded(index):
+            raise IndexError("PCMStore frame has not been decoded")
+        chunk_index, frame_index = divmod(index, self.frames_per_chunk)
+        offset = frame_index * self.frame_size
+        return memoryview(self.chunks[chunk_index])[offset:offset+self.frame_size]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(len(chunk) for chunk in self.chunks.values())
+
+    @property
+    def spilled(self) -> bool:
+        return self.spill_map is not None
+
+    @property
+    def memory_nbytes(self) -> int:
+        return 0 if self.spilled else self.nbytes
+
+    def get_segment(self, index: int) -> Optional[List[int]]:
+        segments = self.segments
+        position = bisect.bisect_right(segments, index, key=lambda segment: segment[0]) - 1
+        if position >= 0:
+            segment = segments[position]
+            if segment[0] <= index < segment[1]:
+                return segment
+        return None
+
+    def is_decoded(self, index: int) -> bool:
+        return self.get_segment(index) is not None
+
+    def get_contiguous_length(self) -> int:
+        # how many frames from the very start are decoded without a gap
+        if self.segments and self.segments[0][0] == 0:
+            return self.segments[0][1]
+        return 0
+
+    def get_first_gap(self) -> Optional[int]:
+        # the first frame that hasn't been decoded, ignoring the end of the store since its length is unknown
+        if not self.segments or self.segments[0][0] > 0:
+            return 0
+        if len(self.segments) > 1:
+            return self.segments[0][1]
+        return None
+
+    def get_next_gap(self, index: int) -> int:
+        # the first frame at or after `index` that hasn't been decoded
+        segment = self.get_segment(index)
+        return segment[1] if segment else index
+
+    def seek(self, index: int) -> None:
+        self.write_index = index
+
+    def mark_decoded(self, index: int) -> None:
+        segments = self.segments
+        position = bisect.bisect_right(segments, index, key=lambda segment: segment[0]) - 1
+        if position >= 0 and segments[position][0] <= index < segments[position][1]:
+            return
+        if position >= 0 and segments[position][1] == index:
+            segment = segments[position]
+            segment[1] += 1
+        else:
+            position += 1
+            segment = [index, index + 1]
+            segments.insert(position, segment)
+        # merge with the following segment once the gap between them is filled
+        if position + 1 < len(segments) and segments[position + 1][0] == segment[1]:
+            segment[1] = segments[position + 1][1]
+            del segments[position + 1]
+        self.decoded_frames += 1
+
+    def append(self, frame: bytes) -> int:
+        index = self.write_index
+        chunk_index, frame_index = divmod(index, self.frames_per_chunk)
+        chunk = self.chunks.get(chunk_index)
+        if chunk is None:
+            chunk = self.chunks[chunk_index] = bytearray(self.chunk_size)
+        offset = frame_index * self.frame_size
+        # same size slice assignment never reallocates the chunk
+        chunk[offset:offset+self.frame_size] = frame
+        # only mark the frame once it is fully written so readers never see a partial frame
+        self.write_index = index + 1
+        self.length = max(self.length, self.write_index)
+        self.mark_decoded(index)
+        return self.write_index
+
+    def trim(self) -> None:
+        # drop the unused tail of the last chunk once nothing else will be written after it
+        if not self.length:
+            return
+        chunk_index = (self.length - 1) // self.frames_per_chunk
+        chunk = self.chunks.get(chunk_index)
+        used = (self.length - chunk_index * self.frames_per_chunk) * self.frame_size
+        if chunk is not None and used < len(chunk):
+            self.chunks[chunk_index] = chunk[:used]
+
+    def spill(self, directory: Optional[str] = None) -> None:
+        # move the chunks into a memory-mapped temporary file so the os can page them out.
+        # only call this once the store is complete (`trim` has been called), the chunks become read only.
+        if self.spilled or not self.chunks:
+            return
+        chunk_indexes = sorted(self.chunks)
+        # the file is unlinked right away, the disk space is freed once the last view of the mmap is gone
+        with tempfile.TemporaryFile(dir=directory) as file:
+            for chunk_index in chunk_indexes:
+                file.write(self.chunks[chunk_index])
+            file.flush()
+            spill_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        view = memoryview(spill_map)
+        chunks = {}
+        offset = 0
+        for chunk_index in chunk_indexes:
+            chunk_length = len(self.chunks[chunk_index])
+            chunks[chunk_index] = view[offset:offset+chunk_length]
+            offset += chunk_length
+        # views handed out before spilling keep the old bytearrays alive until they are dropped
+        self.chunks = chunks
+        self.spill_map = spill_map
+
+    def release(self) -> None:
+        # the mmap is not closed explicitly since the audio thread might still hold a view of it,
+        # it gets unmapped once the last reference is gone
+        self.chunks = {}
+        self.length = 0
+        self.segments = []
+        self.decoded_frames = 0
+        self.write_index = 0
+        self.spill_map = None
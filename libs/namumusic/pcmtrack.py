@@ -0,0 +1,422 @@
+from typing import Callable, Dict, List, Optional
+from enum import Enum, IntEnum
+import threading
+import time
+
+import ffmpeg
+import numpy
+
+from libs.namumusic import pcm
+from libs.namumusic import analysis
+from libs.namumusic import opusencoder
+from libs.namumusic.pcmstore import PCMStore
+
+SAMPLES_PER_SECOND = 48000
+# discord only accepts stereo audio but mono is enough for music bots,
+# so ffmpeg downmixes it and the audio stays mono until it gets mixed
+CHANNELS = 1
+FRAME_SIZE = pcm.MONO_FRAME_SIZE
+TARGET_RMS = 6000
+NORMALIZATION_INTERVAL = 50 # how often (in frames) the normalization gain gets updated while decoding
+SEEK_DECODE_AHEAD = 500 # seeking less than 10 seconds ahead of the decoder just waits for it
+MAX_RESTARTS = 32
+DECODE_SLICE = 250 # how many frames get decoded before the worker moves on to the next track
+READY_FRAMES = 50 # a second of audio, enough to start playing without the read function running dry right away
+# while decoding the loudness of the song isn't known yet, so the silence gets found with the fixed threshold
+SILENCE_LEVEL = analysis.get_silence_level(0)
+
+class DecodePriority(IntEnum):
+    PLAYING = 0
+    NEXT = 1
+    PREFETCH = 2
+
+class Status(Enum):
+    IDLE = 0
+    LOADING = 1
+    CACHING = 2
+    FINISHED = 3
+    FAILED = 4
+
+# the decoded pcm of a single song, this can be shared between multiple `YTDLPAudio`
+# (e.g. the same song queued in two guilds) while each of them keeps its own playback position
+class PCMTrack():
+    def __init__(self, key: Optional[str] = None):
+        self.key = key
+        self.packets = PCMStore()
+        self.status = Status.IDLE
+
+        self.total_rms = 0
+        self.start_silence_index = None
+        self.end_silence_index = None
+        self.first_loud_index = None
+        self.normalization_gain = 1.0
+        # one byte of loudness per frame (see `analysis`), analyzed once the song is decoded
+        # or loaded from `MetadataCache` if the song has been played before
+        self.envelope = bytearray()
+        self.analysis: Optional[analysis.Analysis] = None
+        self.analysis_loaded = False
+        self.crossfade_ends: Dict[int, int] = {}
+
+        self.stream_url = None
+        self.seekable = False
+        # set once the decoder reaches the end of the stream
+        self.total_frames: Optional[int] = None
+        # how many times the decoder had to be restarted to fill in the gaps left by seeking
+        self.restarts = 0
+
+        self.ffmpeg_process = None
+        # frames encoded by `encode` once the track is decoded, with the normalization gain already applied.
+        # set to None if opus isn't available
+        self.opus_packets: Optional[List[bytes]] = []
+        self.opus_nbytes = 0
+        self.opus_encoder = None
+        # the opus frames got dropped while the song was playing, they can come back once it's played again
+        self.opus_dropped = False
+        self.stopped = False
+        self.priority = DecodePriority.PREFETCH
+        # whether the track is queued in (or being worked on by) `DecodeScheduler`
+        self.scheduled = False
+        self.lock = threading.Lock()
+        self.subscribers: List[Callable[['PCMTrack'], None]] = []
+        self.ready_subscribers: List[Callable[['PCMTrack'], None]] = []
+
+        # where everyone sharing the track is playing, so seeking and filling in gaps doesn't leave them on silence.
+        # readers only get added and removed under the lock, the positions themselves are updated from the audio thread
+        self.readers: Dict[int, int] = {}
+
+        # bookkeeping for `PCMCache`
+        self.users = 0
+        self.last_used = time.monotonic()
+        self.on_decoded: Optional[Callable[['PCMTrack'], None]] = None
+
+    def subscribe(self, callback: Callable[['PCMTrack'], None]) -> None:
+        with self.lock:
+            done = self.status in (Status.FINISHED, Status.FAILED)
+            if not done:
+                self.subscribers.append(callback)
+        # the track was already decoded by someone else
+        if done:
+            callback(self)
+
+    def unsubscribe(self, callback: Callable[['PCMTrack'], None]) -> None:
+        with self.lock:
+            try:
+                self.subscribers.remove(callback)
+            except ValueError:
+                pass
+
+    def is_ready(self) -> bool:
+        return self.packets.decoded_frames >= READY_FRAMES or self.status in (Status.FINISHED, Status.FAILED)
+
+    def subscribe_ready(self, callback: Callable[['PCMTrack'], None]) -> None:
+        # gets called (from the decode worker) once the track has enough audio to start playing, or once it ended either way
+        with self.lock:
+            ready = self.is_ready()
+            if not ready:
+                self.ready_subscribers.append(callback)
+        if ready:
+            callback(self)
+
+    def notify_ready(self) -> None:
+        with self.lock:
+            subscribers = self.ready_subscribers
+            self.ready_subscribers = []
+        for subscriber in subscribers:
+            subscriber(self)
+
+    def set_analysis(self, track_analysis: analysis.Analysis) -> None:
+        # everything `finish` would figure out is known before decoding even starts
+        self.analysis = track_analysis
+        self.analysis_loaded = True
+        self.start_silence_index = track_analysis.start_index + 1
+        self.end_silence_index = track_analysis.end_index
+        self.update_normalization_gain()
+
+    def open_ffmpeg(self, stream_url: str, streamable: bool = True, index: int = 0) -> None:
+        self.status = Status.LOADING
+        self.stream_url = stream_url
+        # piped input can't be restarted at an offset, so attachments always get decoded from start to end
+        self.seekable = streamable
+        # starting somewhere else than the start works the same as seeking there right away
+        self.start_ffmpeg(index if streamable else 0)
+
+    def start_ffmpeg(self, index: int) -> None:
+        self.packets.seek(index)
+        if self.seekable:
+            self.ffmpeg_process = (
+                ffmpeg
+                .input(self.stream_url, ss=index * 0.02)
+                .output('pipe:', format="s16le", ar=str(SAMPLES_PER_SECOND), ac=CHANNELS, loglevel="fatal")
+                .run_async(pipe_stdout=True, pipe_stderr=True, quiet=True)
+            )
+        else:
+            self.ffmpeg_process = (
+                ffmpeg
+                .input('pipe:')
+                .output('pipe:', format="s16le", ar=str(SAMPLES_PER_SECOND), ac=CHANNELS, v=0)
+                .run_async(pipe_stdin=True, pipe_stderr=True, pipe_stdout=True, quiet=True)
+            )
+
+    def add_reader(self, reader: int, index: int = 0) -> None:
+        with self.lock:
+            self.readers[reader] = index
+
+    def remove_reader(self, reader: int) -> None:
+        with self.lock:
+            self.readers.pop(reader, None)
+
+    def is_decoder_needed(self, reader: Optional[int] = None) -> bool:
+        # whether anyone other than `reader` is waiting on (or going to run into) the part the decoder is working on right now
+        write_index = self.packets.write_index
+        for other, position in list(self.readers.items()):
+            if other != reader and self.packets.get_next_gap(position) >= write_index:
+                return True
+        return False
+
+    def seek(self, index: int, reader: Optional[int] = None) -> None:
+        with self.lock:
+            if not self.seekable or self.status != Status.LOADING or self.packets.is_decoded(index):
+                return
+            # the decoder is going to get there soon enough by itself
+            write_index = self.packets.write_index
+            if write_index <= index < write_index + SEEK_DECODE_AHEAD:
+                return
+            # restarting would leave whoever shares the track on silence until everything after `index` is decoded,
+            # so `reader` has to wait for the decoder to get there instead
+            if self.is_decoder_needed(reader):
+                return
+            # start decoding from the target instead, the frames in between get filled in afterwards
+            ffmpeg_process = self.ffmpeg_process
+            self.start_ffmpeg(index)
+        try:
+            ffmpeg_process.terminate()
+        except Exception:
+            pass
+
+    def get_resume_index(self) -> Optional[int]:
+        # the gap someone is going to run into first gets filled first
+        nearest = None
+        for position in list(self.readers.values()):
+            gap = self.packets.get_next_gap(position)
+            if self.total_frames is not None and gap >= self.total_frames:
+                continue
+            if nearest is None or gap - position < nearest[0]:
+                nearest = (gap - position, gap)
+        if nearest is not None:
+            return nearest[1]
+        gap = self.packets.get_first_gap()
+        if gap is not None:
+            return gap
+        if self.total_frames is None:
+            return self.packets.get_contiguous_length()
+        return None
+
+    def ingest(self, frame: bytes) -> None:
+        rms = pcm.rms(frame)
+        index = self.packets.write_index
+        self.packets.append(frame)
+        envelope = self.envelope
+        if index >= len(envelope):
+            envelope.extend(bytes(index + 1 - len(envelope)))
+        envelope[index] = analysis.to_level(rms)
+        self.total_rms += rms
+        if self.analysis:
+            return
+
+        # only counts once it stayed loud for a few frames so a click in the silence doesn't count as the start
+        first_index = index - analysis.MIN_LOUD_FRAMES + 1
+        if first_index >= 0 and min(envelope[first_index:index + 1]) >= SILENCE_LEVEL:
+            if self.first_loud_index is None or first_index < self.first_loud_index:
+                self.first_loud_index = first_index
+            if self.end_silence_index is None or index + 1 > self.end_silence_index:
+                self.end_silence_index = index + 1
+        # the start of the song is only known once everything before it has been decoded
+        if self.start_silence_index is None and self.first_loud_index is not None and self.packets.get_contiguous_length() > self.first_loud_index:
+            self.start_silence_index = self.first_loud_index + 1
+        if not self.packets.decoded_frames % NORMALIZATION_INTERVAL:
+            self.update_normalization_gain()
+
+    def decode(self, max_frames: int = DECODE_SLICE) -> bool:
+        # decodes up to `max_frames` and returns whether the track is done,
+        # this lets `DecodeScheduler` switch between tracks instead of one track holding a worker until it ends
+        frames = 0
+        while frames < max_frames:
+            ffmpeg_process = self.ffmpeg_process
+            frame = None if self.stopped else ffmpeg_process.stdout.read(FRAME_SIZE)
+            if frame and len(frame) < FRAME_SIZE:
+                frame += b"\x00" * (FRAME_SIZE - len(frame))
+            ready = False
+            with self.lock:
+                # restarted by `seek`
+                if ffmpeg_process is not self.ffmpeg_process:
+                    continue
+                if frame and not self.packets.is_decoded(self.packets.write_index):
+                    self.ingest(frame)
+                    frames += 1
+                    # whoever is waiting for the track to start gets woken up outside of the lock
+                    if not self.ready_subscribers or self.packets.decoded_frames < READY_FRAMES:
+                        continue
+                    ready = True
+                else:
+                    # this segment is over, either the stream ended or it ran into a segment that was decoded earlier
+                    if not frame and not self.stopped and self.total_frames is None:
+                        # the end of the stream, also covers seeking past the end of the song
+                        self.total_frames = self.packets.write_index
+                    resume_index = self.get_resume_index()
+                    if not self.stopped and self.seekable and resume_index is not None and self.restarts < MAX_RESTARTS:
+                        self.start_ffmpeg(resume_index)
+                        self.restarts += 1
+                    else:
+                        resume_index = None
+            if ready:
+                self.notify_ready()
+                continue
+            if resume_index is None:
+                self.finish()
+                return True
+            try:
+                ffmpeg_process.terminate()
+            except Exception:
+                pass
+        return False
+
+    def read_ffmpeg(self) -> None:
+        while not self.decode():
+            pass
+
+    def finish(self) -> None:
+        with self.lock:
+            if self.packets.decoded_frames and not self.stopped:
+                self.packets.trim()
+                del self.envelope[len(self.packets):]
+                if not self.analysis:
+                    self.analysis = analysis.analyze(bytes(self.envelope))
+                    # the start can't move anymore if the song is already playing
+                    if self.start_silence_index is None:
+                        self.start_silence_index = self.analysis.start_index + 1
+                    self.end_silence_index = self.analysis.end_index
+                self.end_silence_index = min(self.end_silence_index, len(self.packets))
+                self.update_normalization_gain()
+                self.status = Status.FINISHED
+            else:
+                self.status = Status.FAILED
+            subscribers = self.subscribers
+            self.subscribers = []
+
+        for subscriber in subscribers:
+            subscriber(self)
+        self.notify_ready()
+        if self.on_decoded:
+            self.on_decoded(self)
+
+    def needs_encoding(self) -> bool:
+        # frames after a gap (if the decoder gave up on filling it) are left to discord.py to encode.
+        # songs that are only prefetched (or no one uses anymore) aren't worth the memory, they get encoded once they are up next
+        if self.status != Status.FINISHED or self.stopped or not self.users or self.priority > DecodePriority.NEXT:
+            return False
+        return self.opus_packets is not None and len(self.opus_packets) < self.packets.get_contiguous_length()
+
+    def encode(self, max_frames: int = DECODE_SLICE) -> bool:
+        # encodes the next `max_frames` frames to opus and returns whether the track is done.
+        # the normalization gain is only final once the whole song is decoded, so this only runs after `finish`
+        if not self.needs_encoding():
+            return True
+        if not self.opus_encoder:
+            self.opus_encoder = opusencoder.create_encoder()
+            if not self.opus_encoder:
+                self.opus_packets = None
+                return True
+        gain = self.normalization_gain
+        work = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.float32)
+        mono = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.int16)
+        stereo = numpy.zeros(pcm.FRAME_LENGTH * 2, dtype=numpy.int16)
+        for _ in range(max_frames):
+            opus_packets = self.opus_packets
+            if self.stopped or opus_packets is None:
+                return True
+            index = len(opus_packets)
+            if index >= self.packets.get_contiguous_length():
+                break
+            try:
+                frame = self.packets[index]
+            except IndexError:
+                # released while encoding
+                return True
+            pcm.to_stereo(pcm.apply_gain(frame, gain, work, mono), stereo)
+            packet = opusencoder.encode(self.opus_encoder, stereo.tobytes())
+            with self.lock:
+                # dropped by `PCMCache` to save memory
+                if self.opus_packets is not opus_packets:
+                    self.opus_encoder = None
+                    return True
+                opus_packets.append(packet)
+                self.opus_nbytes += len(packet)
+        if self.needs_encoding():
+            return False
+        self.opus_encoder = None
+        return True
+
+    def drop_opus(self, reencode: bool) -> int:
+        # frees the pre-encoded frames and returns how much that freed.
+        # with `reencode` they get encoded again the next time the song is up, else the song keeps playing without them
+        with self.lock:
+            nbytes = self.opus_nbytes
+            if self.opus_packets is not None:
+                self.opus_packets = [] if reencode else None
+                self.opus_dropped = not reencode
+            self.opus_nbytes = 0
+        return nbytes
+
+    def restore_opus(self) -> None:
+        with self.lock:
+            if self.opus_dropped:
+                self.opus_packets = []
+                self.opus_dropped = False
+
+    def get_opus_packet(self, index: int) -> Optional[bytes]:
+        opus_packets = self.opus_packets
+        if opus_packets is not None and 0 <= index < len(opus_packets):
+            return opus_packets[index]
+        return None
+
+    def get_crossfade_end(self, fade_frames: int) -> Optional[int]:
+        # where a crossfade of `fade_frames` should end so it starts on a beat instead of wherever the song happens to be,
+        # this cuts off less than a beat of the end of the song
+        end = self.end_silence_index
+        track_analysis = self.analysis
+        if end is None or self.status != Status.FINISHED or not track_analysis or not track_analysis.beat_period:
+            return end
+        crossfade_end = self.crossfade_ends.get(fade_frames)
+        if crossfade_end is None:
+            period = track_analysis.beat_period
+            start = end - fade_frames
+            window_start = max(self.start_silence_index or 0, start - analysis.BEAT_WINDOW * period)
+            beat = None
+            if start > window_start:
+                beat = analysis.find_last_beat(numpy.frombuffer(self.envelope, dtype=numpy.uint8), window_start, start, period)
+            crossfade_end = end if beat is None else beat + fade_frames
+            self.crossfade_ends[fade_frames] = crossfade_end
+        return crossfade_end
+
+    def update_normalization_gain(self) -> None:
+        # the integrated loudness ignores quiet intros and outros, the running average is only used until it is known
+        if self.analysis and self.analysis.loudness:
+            self.normalization_gain = TARGET_RMS / self.analysis.loudness
+        elif self.total_rms:
+            self.normalization_gain = TARGET_RMS / (self.total_rms / self.packets.decoded_frames)
+
+    def touch(self) -> None:
+        self.last_used = time.monotonic()
+
+    def stop(self) -> None:
+        self.stopped = True
+        try:
+            self.ffmpeg_process.terminate()
+        except Exception:
+            pass
+
+    def release(self) -> None:
+        self.stop()
+        self.packets.release()
+        self.opus_packets = None
+        self.opus_nbytes = 0
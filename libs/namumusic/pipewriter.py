@@ -0,0 +1,59 @@
+from typing import IO, Optional
+import asyncio
+import queue
+import threading
+
+MAX_QUEUED_CHUNKS = 64
+CHUNK_SIZE = 64 * 1024 # up to 4MB buffered per pipe
+
+# feeds data into a blocking pipe (ffmpeg's stdin) from a dedicated thread so the event loop never waits on it.
+# the queue in between is bounded, once ffmpeg stops reading (e.g. its output isn't being decoded right now)
+# `write` stops returning and whoever is feeding it (the download) pauses until there is room again.
+class PipeWriter():
+    def __init__(self, pipe: IO[bytes], max_queued_chunks: int = MAX_QUEUED_CHUNKS):
+        self.pipe = pipe
+        self.queue: queue.Queue[Optional[bytes]] = queue.Queue(maxsize=max_queued_chunks)
+        self.event_loop = asyncio.get_running_loop()
+        self.space_available = asyncio.Event()
+        # set once the pipe broke (ffmpeg got stopped), everything written after that gets dropped
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="PipeWriter", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while True:
+            chunk = self.queue.get()
+            self.event_loop.call_soon_threadsafe(self.space_available.set)
+            if chunk is None:
+                break
+            if self.closed:
+                continue
+            try:
+                self.pipe.write(chunk)
+            except Exception:
+                self.closed = True
+        try:
+            self.pipe.close()
+        except Exception:
+            pass
+
+    async def put(self, chunk: Optional[bytes]) -> None:
+        while True:
+            try:
+                self.queue.put_nowait(chunk)
+                return
+            except queue.Full:
+                self.space_available.clear()
+                # the writer might have made room between the failed put and the clear
+                if self.queue.full():
+                    await self.space_available.wait()
+
+    async def write(self, chunk: bytes) -> bool:
+        # returns False once the pipe is gone so the caller can stop producing
+        if self.closed:
+            return False
+        await self.put(chunk)
+        return not self.closed
+
+    async def close(self) -> None:
+        await self.put(None)
@@ -0,0 +1,120 @@
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+import json
+
+from libs.namumusic.metadata import Metadata
+from libs.namumusic.ytdlpaudio import YTDLPAudio
+
+BATCH_SIZE = 50
+# once this many songs have been played since the last full rewrite, the batches get rewritten from scratch
+MAX_OFFSET = BATCH_SIZE * 4
+
+def serialize_song(audio: YTDLPAudio) -> list:
+    metadata = audio.metadata
+    requester = audio.extras.get("requester")
+    return [
+        metadata.url,
+        # stream urls expire and get looked up again anyway, only attachments need theirs since it's all they have
+        None if audio.streamable else metadata.stream_url,
+        metadata.title,
+        metadata.author,
+        metadata.author_url,
+        metadata.thumbnail_url,
+        metadata.created_on.timestamp() if metadata.created_on else None,
+        metadata.length,
+        audio.streamable,
+        requester.id if requester else None,
+    ]
+
+def deserialize_song(entry: list) -> Tuple[Metadata, bool, Optional[int]]:
+    url, stream_url, title, author, author_url, thumbnail_url, created_on, length, streamable, requester_id = entry
+    metadata = Metadata(url=url, stream_url=stream_url, title=title, author=author, author_url=author_url, thumbnail_url=thumbnail_url,
+                        created_on=datetime.fromtimestamp(created_on) if created_on is not None else None, length=length)
+    return metadata, streamable, requester_id
+
+# checkpoints a player's queue (metadata only) into a vault so it can be restored after a restart.
+# the queue gets stored in json batches of `BATCH_SIZE` songs, one vault row each instead of one row per field.
+# songs only ever get appended to the end or played from the front most of the time,
+# so only the last batch and the small state entry have to be written again in that case.
+class QueueSnapshot():
+    def __init__(self, vault):
+        self.vault = vault
+        # the songs the stored batches were built from, the queue starts at `offset` of these
+        self.songs: List[YTDLPAudio] = []
+        self.offset = 0
+        self.batches = 0
+        self.state: Optional[dict] = None
+
+    def get_batch_key(self, index: int) -> str:
+        return f"queue.{index}"
+
+    def find_offset(self, queue: List[YTDLPAudio]) -> Optional[int]:
+        # where the queue starts in the stored songs, or None if it has changed other than at the ends
+        songs = self.songs
+        if not queue:
+            return len(songs)
+        for start in range(self.offset, len(songs)):
+            if songs[start] is queue[0]:
+                break
+        else:
+            return None
+        stored = songs[start:]
+        if len(queue) < len(stored) or any(a is not b for a, b in zip(stored, queue)):
+            return None
+        return start
+
+    async def save(self, queue: List[YTDLPAudio], state: Dict[str, Any]) -> None:
+        offset = self.find_offset(queue)
+        if offset is None or offset >= MAX_OFFSET:
+            self.songs = list(queue)
+            self.offset = 0
+            dirty_batch = 0
+        else:
+            new_songs = queue[len(self.songs) - offset:]
+            dirty_batch = len(self.songs) // BATCH_SIZE if new_songs else self.batches
+            self.songs += new_songs
+            self.offset = offset
+
+        batches = -(-len(self.songs) // BATCH_SIZE)
+        values = {}
+        for index in range(dirty_batch, batches):
+            values[self.get_batch_key(index)] = json.dumps([serialize_song(audio) for audio in self.songs[index*BATCH_SIZE:(index+1)*BATCH_SIZE]], separators=(",", ":"))
+        state = dict(state, offset=self.offset, batches=batches)
+        if state != self.state:
+            values["queue"] = json.dumps(state, separators=(",", ":"))
+            self.state = state
+        if values:
+            await self.vault.store(values)
+        for index in range(batches, self.batches):
+            await self.vault.delete(self.get_batch_key(index))
+        self.batches = batches
+
+    async def save_state(self, state: Dict[str, Any]) -> None:
+        # for when only the position changed, the batches stay as they are
+        state = dict(state, offset=self.offset, batches=self.batches)
+        if state != self.state:
+            await self.vault.store("queue", json.dumps(state, separators=(",", ":")))
+            self.state = state
+
+    def load(self) -> Tuple[Optional[dict], List[list]]:
+        state = self.vault.get("queue")
+        if not state:
+            return None, []
+        state = json.loads(state)
+        # so the next `save` or `clear` knows which batches are already there
+        self.batches = state["batches"]
+        entries = []
+        for index in range(state["batches"]):
+            batch = self.vault.get(self.get_batch_key(index))
+            if batch:
+                entries += json.loads(batch)
+        return state, entries[state["offset"]:]
+
+    async def clear(self) -> None:
+        for index in range(self.batches):
+            await self.vault.delete(self.get_batch_key(index))
+        await self.vault.delete("queue")
+        self.songs = []
+        self.offset = 0
+        self.batches = 0
+        self.state = None
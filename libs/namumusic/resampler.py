@@ -0,0 +1,46 @@
+import math
+
+import numpy
+
+from libs.namumusic import pcm
+
+MIN_RATE = 0.5
+MAX_RATE = 2.0
+# frames a single output frame can span at `MAX_RATE`, plus the one the last sample interpolates towards
+MAX_SOURCE_FRAMES = math.ceil(MAX_RATE) + 2
+
+# plays the cached pcm back at a different rate by reading it at a fractional index, like a turntable
+# speed and pitch change together (nightcore). everything is preallocated since this runs on the audio thread for every frame
+class Resampler():
+    def __init__(self):
+        self.ramp = numpy.arange(pcm.FRAME_LENGTH, dtype=numpy.float64)
+        self.source = numpy.zeros(MAX_SOURCE_FRAMES * pcm.FRAME_LENGTH, dtype=numpy.float32)
+        self.positions = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.float64)
+        self.fractions = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.float32)
+        self.indexes = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.intp)
+        self.next_samples = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.float32)
+
+    def get_frame_count(self, fraction: float, rate: float) -> int:
+        # how many frames, starting with the one the read starts in, one output frame needs at `rate`.
+        # `fraction` is how far into that first frame the read starts
+        last_sample = int(fraction * pcm.FRAME_LENGTH + rate * (pcm.FRAME_LENGTH - 1)) + 1
+        return last_sample // pcm.FRAME_LENGTH + 1
+
+    def load(self, index: int, frame: bytes) -> None:
+        # copies (and converts) the `index`th source frame into place
+        numpy.copyto(self.source[index * pcm.FRAME_LENGTH:(index + 1) * pcm.FRAME_LENGTH], pcm.as_samples(frame), casting="unsafe")
+
+    def resample(self, fraction: float, rate: float, out: numpy.ndarray) -> numpy.ndarray:
+        # linear interpolation between the two samples around every read position, into the float32 `out`
+        positions = self.positions
+        numpy.multiply(self.ramp, rate, out=positions)
+        positions += fraction * pcm.FRAME_LENGTH
+        numpy.copyto(self.indexes, positions, casting="unsafe")
+        numpy.subtract(positions, self.indexes, out=self.fractions, casting="unsafe")
+        numpy.take(self.source, self.indexes, out=out)
+        self.indexes += 1
+        numpy.take(self.source, self.indexes, out=self.next_samples)
+        self.next_samples -= out
+        self.next_samples *= self.fractions
+        out += self.next_samples
+        return out
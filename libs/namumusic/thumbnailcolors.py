@@ -0,0 +1,64 @@
+from typing import Dict, Iterable, Optional, Tuple
+from io import BytesIO
+import asyncio
+
+import aiohttp
+from cachetools import LRUCache
+from PIL import Image, ImageStat
+
+# the median is barely different on a tiny version of the image and takes a fraction of the time
+THUMBNAIL_SIZE = (64, 64)
+# how long `get_color` waits for a thumbnail that wasn't fetched ahead of time, interactions have to be answered within 3 seconds
+FETCH_TIMEOUT = 1.5
+
+def get_median_color(data: bytes) -> Tuple[int, int, int]:
+    image = Image.open(BytesIO(data))
+    # jpegs get decoded at a lower resolution right away instead of decoding the whole thing and scaling it down
+    image.draft("RGB", THUMBNAIL_SIZE)
+    image = image.convert("RGB")
+    image.thumbnail(THUMBNAIL_SIZE)
+    median = ImageStat.Stat(image).median
+    return median[0], median[1], median[2]
+
+# the embed color of every thumbnail, fetched in the background when songs get queued
+# so `/music current_playing` normally doesn't have to download anything
+class ThumbnailColors():
+    def __init__(self, http_session: Optional[aiohttp.ClientSession] = None, maxsize: int = 1024):
+        self.http_session = http_session
+        # failed thumbnails are cached as None so they don't get downloaded again every time
+        self.colors: LRUCache = LRUCache(maxsize=maxsize)
+        self.pending: Dict[str, asyncio.Task] = {}
+
+    async def fetch(self, url: str) -> Optional[Tuple[int, int, int]]:
+        try:
+            async with self.http_session.get(url) as response:
+                response.raise_for_status()
+                data = await response.read()
+            # decoding the image is too slow for the event loop
+            color = await asyncio.get_running_loop().run_in_executor(None, get_median_color, data)
+        except Exception as e:
+            print(f"ThumbnailColors Exception While Fetching {url}: {e}")
+            color = None
+        self.colors[url] = color
+        self.pending.pop(url, None)
+        return color
+
+    def prefetch(self, urls: Iterable[Optional[str]]) -> None:
+        for url in urls:
+            if url and url not in self.colors and url not in self.pending:
+                self.pending[url] = asyncio.get_running_loop().create_task(self.fetch(url))
+
+    async def get_color(self, url: Optional[str], timeout: float = FETCH_TIMEOUT) -> Optional[Tuple[int, int, int]]:
+        if not url:
+            return None
+        if url in self.colors:
+            return self.colors[url]
+        self.prefetch([url])
+        task = self.pending.get(url)
+        if not task:
+            return self.colors.get(url)
+        try:
+            # shielded so the color still gets cached for next time if this gives up
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.TimeoutError:
+            return None
@@ -3,29 +3,31 @@ from enum import Enum
 from typing import Awaitable
 from typing import Any
 from typing import Optional
+from typing import Tuple
 from asyncinit import asyncinit
 from datetime import datetime
 import math
+import time
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
 import traceback
-import threading
 import aiohttp
 
 import discord
 import yt_dlp
 from urllib.parse import urlparse
-import ffmpeg
-import audioop
+import numpy
 
+from libs.namumusic import pcm
 from libs.namumusic.metadata import Metadata
-
-class Status(Enum):
-    IDLE = 0
-    LOADING = 1
-    CACHING = 2
-    FINISHED = 3
-    FAILED = 4
+from libs.namumusic.pcmstore import PCMStore
+from libs.namumusic.pcmtrack import PCMTrack, Status, DecodePriority
+from libs.namumusic.decodescheduler import DecodeScheduler, get_default_scheduler
+from libs.namumusic.pcmcache import PCMCache
+from libs.namumusic.metadatacache import MetadataCache
+from libs.namumusic.metrics import GuildMetrics
+from libs.namumusic.dsp import DSPChain
+from libs.namumusic.resampler import Resampler
+from libs.namumusic.pipewriter import PipeWriter, CHUNK_SIZE
 
 class PlaybackState(Enum):
     NOT_PLAYING = 1
@@ -45,7 +47,14 @@ class YTDLPAudio(discord.AudioSource):
                        on_loading_finished: Callable[['YTDLPAudio'], Awaitable[Any]] = None,
                        on_failed: Callable[['YTDLPAudio'], Awaitable[Any]] = None,
                        on_read: Callable[['YTDLPAudio', bytes], bytes] = None,
-                       on_clean_up: Callable[['YTDLPAudio'], None] = None):
+                       on_read_gain: Callable[['YTDLPAudio'], float] = None,
+                       on_clean_up: Callable[['YTDLPAudio'], None] = None,
+                       pcm_cache: Optional[PCMCache] = None,
+                       metadata_cache: Optional[MetadataCache] = None,
+                       decode_scheduler: Optional[DecodeScheduler] = None,
+                       metrics: Optional[GuildMetrics] = None,
+                       http_session: Optional[aiohttp.ClientSession] = None,
+                       effects: Optional[DSPChain] = None):
         self.extras = {}
 
         self.playback_state = PlaybackState.NOT_PLAYING
@@ -57,12 +66,25 @@ class YTDLPAudio(discord.AudioSource):
         self.on_finished = on_finished
         self.on_loading_finished = on_loading_finished
         self.on_failed = on_failed
+        self.failed_task: Optional[asyncio.Task] = None
         self.on_read = on_read
+        self.on_read_gain = on_read_gain
         self.status = Status.IDLE
 
-        self.executor = ThreadPoolExecutor()
-        self.read_ffmpeg_future = None
+        self.pcm_cache = pcm_cache
+        self.metadata_cache = metadata_cache
+        self.track: Optional[PCMTrack] = None
+        self.metrics = metrics
+        self.http_session = http_session
+        # applied on top of the gain, the filter history is per song so it can be shared by everything in a player
+        self.effects = effects
+        self._effects_history: Optional[numpy.ndarray] = None
+
+        # queued songs only hold their metadata, they only get a spot in the decode queue once they start caching
+        self.decode_scheduler = decode_scheduler or get_default_scheduler()
+        self.decode_priority = DecodePriority.PREFETCH
         self.event_loop = asyncio.get_running_loop()
+        # restored songs come in as their metadata, attachments included, and already have their title and author
         if type(url) is Metadata:
             self.metadata = url
         else:
@@ -71,58 +93,122 @@ class YTDLPAudio(discord.AudioSource):
                 self.metadata.stream_url = await self.event_loop.run_in_executor(None, self.get_source_url, url)
             else:
                 self.metadata.stream_url = url
-
-        if not streamable:
-            self.metadata.title = urlparse(url).path.split("/")[-1]
-            self.metadata.author = "Discord Attachment"
+                self.metadata.title = urlparse(url).path.split("/")[-1]
+                self.metadata.author = "Discord Attachment"
 
         self.packet_index = 0
-        self.end_silence_index = None
-        self.start_silence_index = None
-
-        self.packets = []
-        self.total_rms = 0
+        # how far into the frame at `packet_index` playback is, only ever not 0 while playing at a different rate
+        self.frame_fraction = 0.0
+        self.resampler: Optional[Resampler] = None
+        self._stereo_buffer: Optional[numpy.ndarray] = None
+        self._gain_buffer: Optional[numpy.ndarray] = None
+        self._output_buffer: Optional[numpy.ndarray] = None
 
         if cache_on_init:
             await self.start_caching()
         
+    @property
+    def packets(self) -> PCMStore:
+        return self.track.packets
+
+    @property
+    def total_rms(self) -> int:
+        return self.track.total_rms
+
+    @property
+    def normalization_gain(self) -> float:
+        return self.track.normalization_gain
+
+    @property
+    def start_silence_index(self) -> Optional[int]:
+        return self.track.start_silence_index
+
+    @property
+    def end_silence_index(self) -> Optional[int]:
+        return self.track.end_silence_index
+
+    def get_cache_key(self) -> Optional[str]:
+        return self.metadata.url or self.metadata.stream_url
+
+    def acquire_track(self) -> PCMTrack:
+        if self.track:
+            self.release_track()
+        if self.pcm_cache:
+            self.track = self.pcm_cache.acquire(self.get_cache_key())
+        else:
+            self.track = PCMTrack()
+        return self.track
+
+    def release_track(self) -> None:
+        track = self.track
+        if not track:
+            return
+        track.unsubscribe(self.on_track_done)
+        track.remove_reader(id(self))
+        if self.pcm_cache:
+            self.pcm_cache.release(track)
+        else:
+            track.release()
+
     async def start_caching(self, reset_stream_url: bool = False) -> None:
         self.status = Status.LOADING
-        samples_per_second = 48000
-        channels = 2
         
         if reset_stream_url:
             self.metadata.stream_url = None
-        if not self.metadata.stream_url:
-            self.metadata.stream_url = await self.event_loop.run_in_executor(None, self.get_source_url, self.metadata.url) 
-        
-        if self.streamable:
-            self.ffmpeg_process = (
-                ffmpeg
-                .input(self.metadata.stream_url)
-                .output('pipe:', format="s16le", ar=str(samples_per_second), ac=channels, loglevel="fatal")
-                .run_async(pipe_stdout=True, pipe_stderr=True, quiet=True)
-            )
+
+        track = self.acquire_track()
+        # only decode the song if no one else is already doing it
+        if track.status == Status.IDLE:
+            if not self.metadata.stream_url:
+                self.metadata.stream_url = await self.event_loop.run_in_executor(None, self.get_stream_url, reset_stream_url)
+            if self.metadata_cache and self.metadata.url and not track.analysis:
+                track_analysis = await self.event_loop.run_in_executor(None, self.metadata_cache.get_analysis, self.metadata.url)
+                if track_analysis:
+                    track.set_analysis(track_analysis)
+            # songs restored from a queue snapshot start decoding where they left off
+            track.open_ffmpeg(self.metadata.stream_url, self.streamable, self.packet_index)
+            if not self.streamable:
+                self.event_loop.create_task(self.input_ffmpeg(track))
+            self.decode_scheduler.submit(track, self.decode_priority)
+        track.subscribe(self.on_track_done)
+        track.add_reader(id(self), self.packet_index)
+
+        # wait for the data the reach 1 second of audio (else the read function will end immediately),
+        # the decode worker wakes us up as soon as it gets there instead of us checking every second
+        ready = asyncio.Event()
+        track.subscribe_ready(lambda track: self.event_loop.call_soon_threadsafe(ready.set))
+        await ready.wait()
+        if track.status != Status.FAILED:
+            if self.on_loading_finished:
+                await self.on_loading_finished(self)
+            if self.status == Status.LOADING:
+                self.status = Status.CACHING
+
+    def on_track_done(self, track: PCMTrack) -> None:
+        # gets called on the decode worker that finished the track, which is shared by every guild,
+        # so it only hands the track over to the event loop instead of waiting on anything there
+        self.event_loop.call_soon_threadsafe(self.on_track_decoded, track)
+
+    def on_track_decoded(self, track: PCMTrack) -> None:
+        # the song might have been cleaned up (or moved on to another track) before this got to run
+        if track is not self.track:
+            return
+        if track.status == Status.FINISHED:
+            self.metadata.length = track.end_silence_index*0.02
+            self.status = Status.FINISHED
+            # attachment urls expire, so theres no point in remembering those
+            if self.metadata_cache and self.metadata.url and track.analysis and not track.analysis_loaded:
+                track.analysis_loaded = True
+                self.event_loop.run_in_executor(None, self.store_analysis, track)
         else:
-            self.ffmpeg_process = (
-                ffmpeg
-                .input('pipe:')
-                .output('pipe:', format="s16le", ar=str(samples_per_second), ac=channels, v=0)
-                .run_async(pipe_stdin=True, pipe_stderr=True, pipe_stdout=True, quiet=True)
-            )
-
-        self.lock = threading.Lock()
-        if not self.streamable:
-            self.event_loop.create_task(self.input_ffmpeg())
-        self.read_ffmpeg_future = self.event_loop.run_in_executor(self.executor, self.read_ffmpeg)
-        # wait for the data the reach 1 second of audio (else the read function will end immediately)
-        while len(self.packets) < 50:
-            if self.status == Status.FAILED:
-                break
-            await asyncio.sleep(1.0)
-        if self.status != Status.FAILED and self.on_loading_finished:
-            await self.on_loading_finished(self)
-            self.status = Status.CACHING
+            self.status = Status.FAILED
+            self.failed()
+
+    def store_analysis(self, track: PCMTrack) -> None:
+        try:
+            self.metadata_cache.store_analysis(self.metadata.url, track.analysis)
+        except Exception as e:
+            print(f"YTDLPAudio {id(self)} Exception While Storing Analysis: {e}")
 
     def start(self, wait: bool = True) -> None:
         if self.start:
@@ -145,70 +231,135 @@ class YTDLPAudio(discord.AudioSource):
                 except Exception:
                     traceback.print_exc()
     
+    def set_decode_priority(self, priority: DecodePriority) -> None:
+        self.decode_priority = priority
+        track = self.track
+        if not track or track.status not in (Status.LOADING, Status.FINISHED):
+            return
+        # a decoded song might still need its opus frames (again), even if it was played before
+        if priority < track.priority or track.needs_encoding():
+            self.decode_scheduler.reprioritize(track, min(priority, track.priority))
+
     def clean_up(self):
-        try:
-            self.ffmpeg_process.terminate()
-        except Exception:
-            pass
-        if self.read_ffmpeg_future:
-            self.read_ffmpeg_future.cancel()
-        self.executor.shutdown(wait=False, cancel_futures=True)
-        self.packets.clear()
+        # the track might still be in use by another guild, so the cache decides whether it gets freed
+        self.release_track()
 
         if self.on_clean_up:
             self.on_clean_up(self)
 
     def failed(self) -> None:
+        # runs on the event loop, retrying waits for the song to decode again so it gets its own task
         if self.on_failed:
-            future=asyncio.run_coroutine_threadsafe(self.on_failed(self), self.event_loop)
-            try:
-                future.result()
-            except Exception:
-                traceback.print_exc()
+            self.failed_task = self.event_loop.create_task(self.report_failed())
+
+    async def report_failed(self) -> None:
+        try:
+            await self.on_failed(self)
+        except Exception:
+            traceback.print_exc()
 
     def read_event(self, packet: bytes) -> Optional[bytes]:
         if self.on_read:
             return self.on_read(self, packet)
 
-    async def input_ffmpeg(self) -> None:
-        async with aiohttp.ClientSession() as session:
+    def get_read_gain(self) -> float:
+        # the gain on top of the normalization gain (e.g. volume, crossfade)
+        if self.on_read_gain:
+            try:
+                return self.on_read_gain(self)
+            except Exception:
+                traceback.print_exc()
+        return 1.0
+
+    def apply_gain(self, packet: bytes, gain: float) -> bytes:
+        if gain == 1.0:
+            return packet
+        if self._gain_buffer is None:
+            # preallocated so applying the gain doesnt allocate on the audio thread
+            self._gain_buffer = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.float32)
+            self._output_buffer = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.int16)
+        return pcm.apply_gain(packet, gain, self._gain_buffer, self._output_buffer).tobytes()
+
+    def set_effects(self, effects: Optional[DSPChain]) -> None:
+        self.effects = effects if effects and not effects.is_identity() else None
+
+    @property
+    def rate(self) -> float:
+        effects = self.effects
+        return effects.rate if effects else 1.0
+
+    def allocate_buffers(self) -> None:
+        if self._gain_buffer is None:
+            self._gain_buffer = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.float32)
+            self._output_buffer = numpy.zeros(pcm.FRAME_LENGTH, dtype=numpy.int16)
+
+    def process_effects(self, work: numpy.ndarray) -> bytes:
+        # the gain has to be applied to `work` already
+        effects = self.effects
+        if effects:
+            if self._effects_history is None:
+                self._effects_history = effects.create_history()
+            effects.process(work, self._effects_history)
+        return pcm.quantize(work, self._output_buffer).tobytes()
+
+    def apply_effects(self, packet: bytes, gain: float) -> bytes:
+        effects = self.effects
+        if not effects:
+            return self.apply_gain(packet, gain)
+        self.allocate_buffers()
+        # all of the gain stages are still one multiply, and every filter is one fft convolution together
+        return self.process_effects(pcm.scale(packet, gain * effects.gain, self._gain_buffer))
+
+    def is_span_decoded(self, index: int, frames: int) -> bool:
+        # frames past the end of the song count as decoded, they are just silence
+        packets = self.packets
+        end_index = self.end_silence_index if self.status == Status.FINISHED else None
+        for frame_index in range(index, index + frames):
+            if end_index is not None and frame_index >= min(end_index, len(packets)):
+                break
+            if not packets.is_decoded(frame_index):
+                return False
+        return True
+
+    def apply_resampled(self, frames: int, rate: float, gain: float) -> bytes:
+        self.allocate_buffers()
+        resampler = self.resampler
+        packets = self.packets
+        first_index = self.packet_index - 1
+        for frame_index in range(first_index, first_index + frames):
+            frame = packets[frame_index] if packets.is_decoded(frame_index) else pcm.MONO_SILENCE
+            resampler.load(frame_index - first_index, frame)
+        work = resampler.resample(self.frame_fraction, rate, self._gain_buffer)
+        work *= gain * self.effects.gain
+        return self.process_effects(work)
+
+    async def input_ffmpeg(self, track: PCMTrack) -> None:
+        # ffmpeg only reads its input as fast as its output gets decoded,
+        # so the download pauses whenever the pipe is full instead of blocking the event loop
+        writer = PipeWriter(track.ffmpeg_process.stdin)
+        session = self.http_session or aiohttp.ClientSession()
+        try:
             async with session.get(self.metadata.stream_url) as response:
-                async for byte in response.content:
-                    try:
-                        self.ffmpeg_process.stdin.write(byte)
-                    except Exception:
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    if not await writer.write(chunk):
                         break
-        self.ffmpeg_process.stdin.close()
-    def read_ffmpeg(self) -> None:
-        while True:
-            pcm = self.ffmpeg_process.stdout.read(3840)
-            if not pcm:
-                break
-            if len(pcm) < 3840:
-                pcm += b"\x00" * (3840 - len(pcm))
-            with self.lock:
-                # discord only accepts mono audio so doing this actually saves some memory
-                pcm = audioop.tomono(pcm, 2, 0.5, 0.5) 
-                rms = audioop.rms(pcm, 2)
-                self.packets.append(pcm)
-                if rms > 500:
-                    if self.start_silence_index is None:
-                        self.start_silence_index = len(self.packets)
-                        self.packet_index = self.start_silence_index
-                    self.end_silence_index = len(self.packets)
-                self.total_rms += rms
-
-        if self.packets:
-            if self.start_silence_index is None:
-                self.start_silence_index = 0
-            if self.end_silence_index is None:
-                self.end_silence_index = len(self.packets)
-
-            self.metadata.length = self.end_silence_index*0.02
-            self.status = Status.FINISHED
-        else:
-            self.failed()
-            self.status = Status.FAILED
+        except Exception as e:
+            print(f"YTDLPAudio {id(self)} Exception While Downloading Attachment: {e}")
+        finally:
+            await writer.close()
+            if session is not self.http_session:
+                await session.close()
+
+    def get_stream_url(self, refresh: bool = False) -> str:
+        # stream urls expire, so they get refreshed on their own instead of resolving the whole song again
+        if self.metadata_cache and not refresh:
+            stream_url = self.metadata_cache.get_stream_url(self.metadata.url)
+            if stream_url:
+                return stream_url
+        stream_url = self.get_source_url(self.metadata.url)
+        if self.metadata_cache:
+            self.metadata_cache.store_stream_url(self.metadata.url, stream_url)
+        return stream_url
 
     def get_source_url(self, search: str) -> str:
         ydl_opts = {'format': 'bestaudio/best', 'noplaylist': True , 'quiet': True} 
@@ -248,53 +399,146 @@ class YTDLPAudio(discord.AudioSource):
             
         return url
 
-    def read(self) -> bytes:
+    def read_frame(self, opus: bool = False) -> Tuple[Optional[bytes], bool]:
+        metrics = self.metrics
+        if not metrics:
+            return self.next_frame(opus)
+        start = time.perf_counter_ns()
+        packet, is_opus = self.next_frame(opus)
+        if packet:
+            segment = self.packets.get_segment(self.packet_index)
+            metrics.record_source_read(time.perf_counter_ns() - start, segment[1] - self.packet_index if segment else 0, is_opus)
+        return packet, is_opus
+
+    def next_frame(self, opus: bool = False) -> Tuple[Optional[bytes], bool]:
+        # returns the next frame and whether it is opus encoded,
+        # opus frames are only returned if asked for and nothing has to be done to the frame
         if self.status not in (Status.CACHING, Status.FINISHED):
             self.playback_state = PlaybackState.NOT_PLAYING
-            return
+            return None, False
+
+        # skip the silence at the start of the song
+        start_silence_index = self.start_silence_index
+        if start_silence_index is not None and self.packet_index < start_silence_index:
+            self.packet_index = start_silence_index
+            self.frame_fraction = 0.0
 
         self.packet_index += 1
-        if self.packet_index > self.end_silence_index:
+        if self.end_silence_index is not None and self.packet_index > self.end_silence_index and self.status == Status.FINISHED:
             if self.playback_state == PlaybackState.FINISHED:
-                return b''
+                return b'', False
             if not self.loop:
                 if not self.playback_state == PlaybackState.TRANSITIONING:
                     self.playback_state = PlaybackState.FINISHED
                     self.finished()
                 self.playback_state = PlaybackState.FINISHED
                 self.clean_up()
-                return b''
+                return b'', False
             self.packet_index = self.start_silence_index
+            self.frame_fraction = 0.0
+
+        # lets the track know which gaps to fill in first (see `PCMTrack.get_resume_index`)
+        readers = self.track.readers
+        if id(self) in readers:
+            readers[id(self)] = self.packet_index - 1
+
+        # at a different rate one frame of output takes a few frames (or part of one) of the song
+        rate = self.rate
+        if rate == 1.0:
+            frames = 1
+            self.frame_fraction = 0.0
+        else:
+            if self.resampler is None:
+                self.resampler = Resampler()
+            frames = self.resampler.get_frame_count(self.frame_fraction, rate)
+
+        if not self.is_span_decoded(self.packet_index-1, frames):
+            # the decoder hasn't caught up yet (or is still seeking), so play silence instead of ending the song
+            if self.track.status == Status.LOADING:
+                self.packet_index -= 1
+            if self.metrics:
+                self.metrics.record_underrun()
+            return pcm.MONO_SILENCE, False
+
+        gain = self.get_read_gain()
+        packet = None
+        is_opus = False
+        # the pre-encoded frames already have the normalization gain applied, so they can only be sent untouched
+        if opus and gain == 1.0 and not self.on_read and not self.effects:
+            packet = self.track.get_opus_packet(self.packet_index-1)
+            is_opus = packet is not None
+
+        if not is_opus:
+            if rate == 1.0:
+                packet = self.apply_effects(self.packets[self.packet_index-1], self.normalization_gain * gain)
+            else:
+                packet = self.apply_resampled(frames, rate, self.normalization_gain * gain)
 
-        packet = audioop.tostereo(self.packets[self.packet_index-1], 2, 1.0, 1.0)
-        # discord.py for some reason does not like mono audio so we have to convert it back to stereo
-
-        # leave it to the user to motifiy the packet
-        # e.g. custom effects
-        try:
-            motified_packet = self.read_event(packet)
-            if motified_packet:
-                packet = motified_packet
-        except Exception:
-            traceback.print_exc()
+            # leave it to the user to motifiy the packet
+            # e.g. custom effects
+            try:
+                motified_packet = self.read_event(packet)
+                if motified_packet:
+                    packet = motified_packet
+            except Exception:
+                traceback.print_exc()
 
         # this gets sent here because the `PlaybackState` doesnt get applied until the player sets it 
-        if self.packet_index == self.start_silence_index+1:
+        if start_silence_index is not None and self.packet_index == start_silence_index+1:
+            if self.pcm_cache:
+                self.pcm_cache.touch(self.track)
             self.start(False)
 
-        return packet
+        if rate != 1.0:
+            # the next read starts `rate` frames after this one, `packet_index` gets incremented again by then
+            position = self.packet_index - 1 + self.frame_fraction + rate
+            self.packet_index = int(position)
+            self.frame_fraction = position - self.packet_index
+
+        return packet, is_opus
+
+    def read_mono(self) -> bytes:
+        return self.read_frame()[0]
+
+    def read_opus(self) -> Tuple[Optional[bytes], bool]:
+        # used by `Mixer` when this is the only thing playing, so discord.py doesn't have to encode the frame again
+        return self.read_frame(opus=True)
+
+    def read(self) -> bytes:
+        packet = self.read_mono()
+        if not packet:
+            return packet
+        # discord.py for some reason does not like mono audio so we have to convert it back to stereo
+        # `Mixer` calls `read_mono` directly and does this while mixing instead
+        if self._stereo_buffer is None:
+            self._stereo_buffer = numpy.zeros(pcm.STEREO_FRAME_SIZE // 2, dtype=numpy.int16)
+        return pcm.to_stereo(packet, self._stereo_buffer).tobytes()
 
     def is_opus(self):
         return False
 
     def get_position(self) -> float:
-        return self.packet_index * 0.02
+        # in song time, at a different rate this moves faster or slower than the actual time
+        return (self.packet_index + self.frame_fraction) * 0.02
+
+    def get_end_time(self, crossfade_length: float) -> Optional[float]:
+        # where a crossfade of `crossfade_length` (in song time) should end, lined up with the beat once the song is analyzed
+        track = self.track
+        if self.loop or not track or track.status != Status.FINISHED:
+            return self.metadata.length
+        end_index = track.get_crossfade_end(round(crossfade_length / 0.02))
+        return end_index * 0.02 if end_index is not None else self.metadata.length
 
     def set_loop(self, bool: bool) -> None:
         self.loop = bool
 
-    # FIXME: find a better way to do this
-    def seek(self, position: int):
-        while len(self.packets) * 0.02 < position:
-            pass
-        self.packet_index = (math.floor(position / 0.02))
\ No newline at end of file
+    def seek(self, position: float):
+        # doesn't block, if the position hasn't been decoded yet the track restarts ffmpeg there
+        # and `read` plays silence until the first frames come in
+        packet_index = math.floor(position / 0.02)
+        readers = self.track.readers
+        if id(self) in readers:
+            readers[id(self)] = packet_index
+        self.track.seek(packet_index, id(self))
+        self.packet_index = packet_index
+        self.frame_fraction = 0.0
\ No newline at end of file
@@ -1,13 +1,23 @@
+from typing import Awaitable
 from typing import Callable
 from typing import Optional
 from typing import List
+from typing import Union
+from typing import Tuple
 import asyncio
-import math
 
-import audioop
+import aiohttp
+import numpy
 from libs.namumusic.mixer import Mixer
 from libs.namumusic.ytdlpaudio import PlaybackState, YTDLPAudio, Status
+from libs.namumusic.pcmcache import PCMCache
+from libs.namumusic.pcmtrack import DecodePriority
+from libs.namumusic.decodescheduler import DecodeScheduler
+from libs.namumusic.metrics import GuildMetrics
+from libs.namumusic.metadatacache import MetadataCache
 from libs.namumusic.metadatagetter import get_metadata
+from libs.namumusic.metadata import Metadata
+from libs.namumusic.dsp import DSPChain
 import discord
 
 class YTDLPMusicPlayer():
@@ -15,7 +25,12 @@ class YTDLPMusicPlayer():
                 vc: discord.VoiceClient,
                 on_start: Callable[[YTDLPAudio, 'YTDLPMusicPlayer'], None] = None,
                 on_finished: Callable[[YTDLPAudio, 'YTDLPMusicPlayer'], None] = None,
-                volume: float = 1.0):
+                volume: float = 1.0,
+                pcm_cache: Optional[PCMCache] = None,
+                metadata_cache: Optional[MetadataCache] = None,
+                decode_scheduler: Optional[DecodeScheduler] = None,
+                metrics: Optional[GuildMetrics] = None,
+                http_session: Optional[aiohttp.ClientSession] = None):
         self.extras = {}
 
         self.volume = volume
@@ -24,12 +39,30 @@ class YTDLPMusicPlayer():
         self.on_finished = on_finished
 
         self.crossfade = True
-        self.crossfade_length = 2.0
-        self.crossfade_strength = 3.0
+        self._crossfade_length = 2.0
+        self._crossfade_strength = 3.0
+        self.crossfade_table: Optional[numpy.ndarray] = None
 
+        # how long before the crossfade starts the next song starts decoding,
+        # songs further down the queue are only metadata until they get there
+        self.prefetch_time = 30.0
+        self.prefetched: Optional[YTDLPAudio] = None
+        self.event_loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # shared by every song in the queue, None while no effects are on so the songs can send pre-encoded opus frames
+        self.effects: Optional[DSPChain] = None
+
+        self.pcm_cache = pcm_cache
+        self.metadata_cache = metadata_cache
+        self.decode_scheduler = decode_scheduler
+        self.metrics = metrics
+        self.http_session = http_session
         self.mixer = Mixer()
+        self.mixer.metrics = metrics
         self.vc = vc
         self.queue: List[YTDLPAudio] = [] # maybe use deque?
+        # bumped whenever the queue changes so it only gets checkpointed when it has to (see `QueueSnapshot`)
+        self.queue_version = 0
         self.current_song: YTDLPAudio = None
 
     async def finished(self, audio) -> None:
@@ -37,15 +70,18 @@ class YTDLPMusicPlayer():
             await self.on_finished(audio, self)
 
     def self_clean_up(self):
-        for song in self.queue:
+        # `clean_up` removes the song from the queue, so it goes over a copy or every other song would be skipped
+        for song in list(self.queue):
             song.clean_up()
         self.queue.clear()
+        self.queue_version += 1
         self.mixer.clear_channels()
         self.current_song = None
 
     def clean_up(self, audio) -> None:
         try:
             self.queue.remove(audio)
+            self.queue_version += 1
         except Exception as e:
             print(f"Player {id(self)} Exception While Removing From Queue: {e}")
         if not self.queue:
@@ -67,29 +103,65 @@ class YTDLPMusicPlayer():
             else:
                 self.current_song.clean_up()
 
-    def easeInOutSine(self, x: float) -> float:
-        return (-(math.cos(math.pi * x) - 1) / 2)**self.crossfade_strength
+    @property
+    def crossfade_length(self) -> float:
+        return self._crossfade_length
+
+    @crossfade_length.setter
+    def crossfade_length(self, crossfade_length: float) -> None:
+        self._crossfade_length = crossfade_length
+        self.crossfade_table = None
+
+    @property
+    def crossfade_strength(self) -> float:
+        return self._crossfade_strength
+
+    @crossfade_strength.setter
+    def crossfade_strength(self, crossfade_strength: float) -> None:
+        self._crossfade_strength = crossfade_strength
+        self.crossfade_table = None
+
+    def easeInOutSine(self, x: float | numpy.ndarray) -> float | numpy.ndarray:
+        return (-(numpy.cos(numpy.pi * x) - 1) / 2)**self.crossfade_strength
 
-    def on_audio_read(self, audio: YTDLPAudio, packet: bytes) -> bytes:
-        # normalize the audio
-        scale_factor = 6000 / (audio.total_rms / len(audio.packets))
-        packet = audioop.mul(packet, 2, scale_factor)
+    def get_crossfade_table(self) -> numpy.ndarray:
+        # the envelope only depends on the crossfade settings, so it gets computed once per setting change
+        # instead of once per frame. the table is indexed by the number of frames into the crossfade.
+        crossfade_table = self.crossfade_table
+        if crossfade_table is None:
+            frames = max(1, round(self.crossfade_length / 0.02))
+            crossfade_table = self.easeInOutSine(numpy.arange(frames + 1) / frames)
+            self.crossfade_table = crossfade_table
+        return crossfade_table
+
+    def get_crossfade_gain(self, time: float) -> float:
+        if time <= 0:
+            return 0.0
+        crossfade_table = self.get_crossfade_table()
+        return float(crossfade_table[min(int(time / 0.02), len(crossfade_table) - 1)])
+
+    def on_audio_read_gain(self, audio: YTDLPAudio) -> float:
+        # the audio normalizes itself, this only adds the overall volume and the crossfade on top.
+        # while this stays at 1.0 the audio can send its pre-encoded opus frames
+        gain = self.volume
+        if audio is self.current_song:
+            self.update_prefetch(audio)
         
-        # this entire thing manages the playbackstate of the audio
+        # this entire thing manages the playbackstate of the audio.
+        # the position is in song time, the crossfade is in actual time so it sounds the same at any rate
         if audio.metadata.length and self.crossfade:
-            current_time = audio.get_position()
-            time_left = audio.metadata.length - current_time
+            rate = audio.rate
+            position = audio.get_position()
+            current_time = position / rate
+            time_left = (audio.get_end_time(self.crossfade_length * rate) - position) / rate
             if time_left <= self.crossfade_length:
                 if len(self.mixer.get_channel("music")) < 2 and not audio.playback_state == PlaybackState.TRANSITIONING:
                     audio.playback_state = PlaybackState.TRANSITIONING
                     audio.finished(wait=False)
-                if time_left <= 0:
-                    packet = audioop.mul(packet, 2, 0)
-                else:
-                    packet = audioop.mul(packet, 2, self.easeInOutSine(time_left / self.crossfade_length) )
+                gain *= self.get_crossfade_gain(time_left)
             
             elif current_time <= self.crossfade_length:
-                packet = audioop.mul(packet, 2, self.easeInOutSine(current_time / self.crossfade_length) )
+                gain *= self.get_crossfade_gain(current_time)
                 audio.playback_state = PlaybackState.TRANSITIONING
             
             else:
@@ -97,10 +169,8 @@ class YTDLPMusicPlayer():
         else:
             audio.playback_state = PlaybackState.PLAYING
 
-        # set overall volume
-        packet = audioop.mul(packet, 2, self.volume)
-
-        return packet
+        # every gain stage gets folded into a single multiply over the frame by the audio
+        return gain
 
     def get_next_song(self) -> YTDLPAudio:
         if len(self.queue) > 1:
@@ -110,6 +180,11 @@ class YTDLPMusicPlayer():
     def set_volume(self, volume: float) -> None:
         self.volume = volume
 
+    def set_effects(self, effects: Optional[DSPChain]) -> None:
+        self.effects = effects if effects and not effects.is_identity() else None
+        for audio in self.queue:
+            audio.set_effects(self.effects)
+
     def set_loop(self, bool: bool) -> None:
         for ac in self.queue:
             ac.set_loop(bool)
@@ -128,11 +203,9 @@ class YTDLPMusicPlayer():
         if not self.current_song:
             return None
 
-        loop = asyncio.get_running_loop()
-        for audio in self.queue[1:][:3]:
-            if audio.status == Status.IDLE:
-                loop.create_task(audio.start_caching())
-        if self.current_song == Status.IDLE:
+        self.event_loop = asyncio.get_running_loop()
+        self.current_song.set_decode_priority(DecodePriority.PLAYING)
+        if self.current_song.status == Status.IDLE:
             await self.current_song.start_caching()
 
         self.mixer.add_audio_source("music", self.current_song)
@@ -141,20 +214,58 @@ class YTDLPMusicPlayer():
             self.vc.play(self.mixer, signal_type="music", bitrate=512)
         return self.current_song
 
-    async def add_song(self, url: str, streamable: bool = True) -> YTDLPAudio:
+    def get_prefetch_window(self) -> float:
+        if self.crossfade:
+            return self.prefetch_time + self.crossfade_length
+        return self.prefetch_time
+
+    def update_prefetch(self, audio: YTDLPAudio) -> None:
+        # runs on the audio thread for every frame of the current song, so this has to stay cheap
+        next_song = self.get_next_song()
+        if not next_song or next_song is self.prefetched or audio.loop or not audio.metadata.length or not self.event_loop:
+            return
+        if (audio.metadata.length - audio.get_position()) / audio.rate <= self.get_prefetch_window():
+            self.prefetched = next_song
+            self.event_loop.call_soon_threadsafe(self.prefetch)
+
+    def prefetch(self) -> None:
+        # only the song that is about to play gets decoding resources, the rest of the queue is just metadata
+        next_song = self.get_next_song()
+        if not next_song:
+            return
+        self.prefetched = next_song
+        next_song.set_decode_priority(DecodePriority.NEXT)
+        if next_song.status == Status.IDLE:
+            asyncio.get_running_loop().create_task(next_song.start_caching())
+
+    def create_audio(self, entry: Union[str, Metadata], streamable: bool = True) -> Awaitable[YTDLPAudio]:
+        return YTDLPAudio(entry, streamable=streamable, cache_on_init=False, on_start=self.start, on_finished=self.finished, on_loading_finished=self.loaded, on_read_gain=self.on_audio_read_gain, on_clean_up=self.clean_up, on_failed=self.failed, pcm_cache=self.pcm_cache, metadata_cache=self.metadata_cache, decode_scheduler=self.decode_scheduler, metrics=self.metrics, http_session=self.http_session, effects=self.effects)
+
+    async def add_song(self, url: str, streamable: bool = True) -> List[YTDLPAudio]:
         loop = asyncio.get_running_loop()
-        audios = []
         if streamable:
-            entries = await loop.run_in_executor(None, get_metadata, url)
-            for entry in entries:
-                audios.append(await YTDLPAudio(entry, streamable=streamable, cache_on_init=len(self.queue)+len(audios)<=1, on_start=self.start, on_finished=self.finished, on_loading_finished=self.loaded, on_read=self.on_audio_read, on_clean_up=self.clean_up, on_failed=self.failed))
+            entries = await loop.run_in_executor(None, get_metadata, url, self.metadata_cache)
         else:
-            audios = [await YTDLPAudio(url, streamable=streamable, cache_on_init=len(self.queue)+len(audios)<=1, on_start=self.start, on_finished=self.finished, on_loading_finished=self.loaded, on_read=self.on_audio_read, on_clean_up=self.clean_up, on_failed=self.failed)]
+            entries = [url]
+        # none of these start decoding here so creating a few hundred of them for a playlist is cheap,
+        # the first one starts loading once `play` gets called and the rest once they get close to playing
+        audios = list(await asyncio.gather(*(self.create_audio(entry, streamable) for entry in entries)))
         self.queue += audios
+        self.queue_version += 1
         if (len(self.queue) > 1 and self.queue[1].playback_state == PlaybackState.NOT_PLAYING and self.queue[0].playback_state == PlaybackState.TRANSITIONING):
             self.current_song.finished(wait=False)
         return audios
 
+    async def restore(self, entries: List[Tuple[Metadata, bool]], position: float = 0.0) -> List[YTDLPAudio]:
+        # rebuilds a queue from a snapshot, none of the songs have to go through yt-dlp again
+        # and only the first one starts decoding (from where it left off)
+        audios = list(await asyncio.gather(*(self.create_audio(metadata, streamable) for metadata, streamable in entries)))
+        self.queue += audios
+        if audios and position:
+            audios[0].packet_index = int(position / 0.02)
+        self.queue_version += 1
+        return audios
+
     async def play_next_song(self, force=True) -> YTDLPAudio:
         next_song = self.get_next_song()
         if not next_song:
@@ -0,0 +1,129 @@
+from typing import Any, Callable, Dict, List, Tuple
+import struct
+
+# every value stored under a key as a single blob instead of one row per element (see `VaultManager.walk_execute_data`).
+# a tag byte followed by the value, containers are a count followed by their items.
+# the tags are the same as `UniversalType`, so it round-trips the same types the row tree does
+
+# `data_type` of a row holding an encoded value, outside of what `UniversalType` uses so both kinds of rows can sit in the same vault
+ENCODED_TYPE = 64
+
+NONE = 0
+LIST = 1
+TUPLE = 2
+SET = 3
+DICT = 4
+INT = 5
+FLOAT = 6
+STR = 7
+BOOL = 8
+COMPLEX = 9
+BYTES = 10
+# ints that don't fit into 64 bits
+BIG_INT = 11
+
+INT64 = struct.Struct("<q")
+FLOAT64 = struct.Struct("<d")
+COMPLEX128 = struct.Struct("<dd")
+LENGTH = struct.Struct("<I")
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+CONTAINERS = {list: LIST, tuple: TUPLE, set: SET}
+
+def encode_into(value: Any, out: List[bytes]) -> None:
+    # `type() is` instead of isinstance so bools don't end up as ints and subclasses don't sneak through
+    value_type = type(value)
+    if value is None:
+        out.append(b"\x00")
+    elif value_type is bool:
+        out.append(b"\x08\x01" if value else b"\x08\x00")
+    elif value_type is int:
+        if INT64_MIN <= value <= INT64_MAX:
+            out.append(b"\x05" + INT64.pack(value))
+        else:
+            data = value.to_bytes((value.bit_length() + 8) // 8, "little", signed=True)
+            out.append(b"\x0b" + LENGTH.pack(len(data)) + data)
+    elif value_type is float:
+        out.append(b"\x06" + FLOAT64.pack(value))
+    elif value_type is str:
+        data = value.encode("utf-8")
+        out.append(b"\x07" + LENGTH.pack(len(data)) + data)
+    elif value_type is bytes:
+        out.append(b"\x0a" + LENGTH.pack(len(value)) + value)
+    elif value_type is complex:
+        out.append(b"\x09" + COMPLEX128.pack(value.real, value.imag))
+    elif value_type is dict:
+        out.append(b"\x04" + LENGTH.pack(len(value)))
+        for key, item in value.items():
+            encode_into(key, out)
+            encode_into(item, out)
+    elif value_type in CONTAINERS:
+        out.append(bytes((CONTAINERS[value_type],)) + LENGTH.pack(len(value)))
+        for item in value:
+            encode_into(item, out)
+    else:
+        raise TypeError(f"Can't encode {value_type.__name__} into a vault")
+
+def encode(value: Any) -> bytes:
+    out = []
+    encode_into(value, out)
+    return b"".join(out)
+
+def decode_sequence(data: bytes, offset: int) -> Tuple[list, int]:
+    count, = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    items = []
+    for _ in range(count):
+        item, offset = decode_from(data, offset)
+        items.append(item)
+    return items, offset
+
+def decode_from(data: bytes, offset: int) -> Tuple[Any, int]:
+    # returns the value starting at `offset` and where the next one starts
+    tag = data[offset]
+    offset += 1
+    if tag == INT:
+        return INT64.unpack_from(data, offset)[0], offset + INT64.size
+    if tag == STR or tag == BYTES or tag == BIG_INT:
+        length, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        chunk = data[offset:offset + length]
+        if tag == STR:
+            return chunk.decode("utf-8"), offset + length
+        if tag == BIG_INT:
+            return int.from_bytes(chunk, "little", signed=True), offset + length
+        return bytes(chunk), offset + length
+    if tag == FLOAT:
+        return FLOAT64.unpack_from(data, offset)[0], offset + FLOAT64.size
+    if tag == BOOL:
+        return data[offset] == 1, offset + 1
+    if tag == NONE:
+        return None, offset
+    if tag == COMPLEX:
+        real, imag = COMPLEX128.unpack_from(data, offset)
+        return complex(real, imag), offset + COMPLEX128.size
+    if tag == DICT:
+        count, = LENGTH.unpack_from(data, offset)
+        offset += LENGTH.size
+        value = {}
+        for _ in range(count):
+            key, offset = decode_from(data, offset)
+            value[key], offset = decode_from(data, offset)
+        return value, offset
+    if tag in SEQUENCE_TYPES:
+        items, offset = decode_sequence(data, offset)
+        return (items if tag == LIST else SEQUENCE_TYPES[tag](items)), offset
+    raise ValueError(f"Unknown vault value tag {tag}")
+
+SEQUENCE_TYPES: Dict[int, Callable] = {LIST: list, TUPLE: tuple, SET: set}
+
+def decode(data: bytes) -> Any:
+    value, _ = decode_from(data, 0)
+    return value
+
+# the ways a vault can lay out its values, `VaultManager.vault_store` picks one with `Vault.codec`.
+# reading doesn't care, every vault can always read both
+ROWS = "rows"
+BINARY = "binary"
+CODECS = (ROWS, BINARY)
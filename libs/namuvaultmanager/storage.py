@@ -0,0 +1,131 @@
+from typing import List, Optional, Set
+
+COLUMNS = "key, value, data_type, continuous_id, id, parent_id, parent_key"
+
+# how the rows of every vault are laid out in the database, `VaultManager` runs these in its executor.
+# both layouts store the exact same rows, only where they go is different
+
+# one table per vault ('{owner}.{group}'), the original layout
+class TableStorage():
+    name = "tables"
+
+    def __init__(self):
+        # so `CREATE TABLE IF NOT EXISTS` only runs once per vault instead of before every read and write
+        self.created_tables: Set[str] = set()
+
+    def get_table(self, owner: str, group: Optional[str] = None) -> str:
+        return f"{owner}.{group}" if group else str(owner)
+
+    def prepare(self, connection) -> None:
+        pass
+
+    def migrate_next(self, connection) -> bool:
+        return False
+
+    def create_table(self, connection, table: str) -> None:
+        if table in self.created_tables:
+            return
+        connection.execute(f"CREATE TABLE IF NOT EXISTS '{table}'(key INTEGER UNIQUE, value, data_type INT, continuous_id INTEGER, id INTEGER, parent_id INTEGER, parent_key INTEGER)")
+        self.created_tables.add(table)
+
+    def get_all(self, connection, owner: str, group: Optional[str]) -> List[tuple]:
+        table = self.get_table(owner, group)
+        with connection:
+            self.create_table(connection, table)
+            return connection.execute(f"SELECT {COLUMNS} FROM '{table}'").fetchall()
+
+    def store(self, connection, owner: str, group: Optional[str], keys: List[tuple], execute_data: List[tuple]) -> None:
+        table = self.get_table(owner, group)
+        self.create_table(connection, table)
+        connection.executemany(f"DELETE FROM '{table}' WHERE key = ? OR parent_key = ?", keys)
+        connection.executemany(f"INSERT INTO '{table}' ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)", execute_data)
+
+    def delete(self, connection, owner: str, group: Optional[str], key: int) -> None:
+        table = self.get_table(owner, group)
+        self.create_table(connection, table)
+        connection.execute(f"DELETE FROM '{table}' WHERE key = ? OR parent_key = ?", (key, key))
+
+    def clear(self, connection, owner: str, group: Optional[str]) -> None:
+        table = self.get_table(owner, group)
+        connection.execute(f"DROP TABLE IF EXISTS '{table}'")
+        self.created_tables.discard(table)
+
+# every vault in one table keyed by (owner, group), so the schema stays the same size no matter how many users there are.
+# vaults still in their own table from `TableStorage` get moved over the first time they are loaded,
+# and `migrate_next` moves the rest over in the background
+class SingleTableStorage():
+    name = "single"
+
+    def __init__(self):
+        # tables from `TableStorage` that haven't been moved yet
+        self.legacy_tables: Set[str] = set()
+
+    def prepare(self, connection) -> None:
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS vault_rows(
+                    owner TEXT NOT NULL, "group" TEXT NOT NULL, key INTEGER, value, data_type INT,
+                    continuous_id INTEGER, id INTEGER, parent_id INTEGER, parent_key INTEGER)
+            """)
+            # loading a vault is a range scan over the first one, deleting a key uses both.
+            # the first one holds every column `get_all` selects so loading never has to look rows up in the table
+            connection.execute('DROP INDEX IF EXISTS vault_rows_key')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS vault_rows_covering ON vault_rows(owner, "group", {COLUMNS})')
+            connection.execute('CREATE INDEX IF NOT EXISTS vault_rows_parent_key ON vault_rows(owner, "group", parent_key)')
+            self.legacy_tables = {name for (name,) in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND name != 'vault_rows' AND name NOT LIKE 'sqlite_%'").fetchall()}
+
+    def get_location(self, owner: str, group: Optional[str]) -> tuple:
+        return str(owner), group or ""
+
+    def migrate(self, connection, owner: str, group: Optional[str]) -> None:
+        table = f"{owner}.{group}" if group else str(owner)
+        if table not in self.legacy_tables:
+            return
+        with connection:
+            # someone else might have moved it in the meantime
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchall():
+                connection.execute(f"""
+                    INSERT INTO vault_rows (owner, "group", {COLUMNS}) SELECT ?, ?, {COLUMNS} FROM '{table}'
+                """, self.get_location(owner, group))
+                connection.execute(f"DROP TABLE '{table}'")
+        self.legacy_tables.discard(table)
+
+    def migrate_next(self, connection) -> bool:
+        # moves one of the remaining tables over, returns whether there was one to move
+        if not self.legacy_tables:
+            return False
+        table = next(iter(self.legacy_tables))
+        # the owner is never a string with a dot in it, only the group can be
+        owner, _, group = table.partition(".")
+        self.migrate(connection, owner, group or None)
+        self.legacy_tables.discard(table)
+        return True
+
+    def get_all(self, connection, owner: str, group: Optional[str]) -> List[tuple]:
+        self.migrate(connection, owner, group)
+        # the rows of a list have to come back in the order they were written, which the covering index doesn't keep.
+        # every index entry has the rowid in it, so this only sorts the rows of this vault without touching the table
+        with connection:
+            return connection.execute(f'SELECT {COLUMNS} FROM vault_rows WHERE owner = ? AND "group" = ? ORDER BY rowid',
+                                      self.get_location(owner, group)).fetchall()
+
+    def store(self, connection, owner: str, group: Optional[str], keys: List[tuple], execute_data: List[tuple]) -> None:
+        self.migrate(connection, owner, group)
+        location = self.get_location(owner, group)
+        connection.executemany('DELETE FROM vault_rows WHERE owner = ? AND "group" = ? AND (key = ? OR parent_key = ?)',
+                               [location + key for key in keys])
+        connection.executemany(f'INSERT INTO vault_rows (owner, "group", {COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                               [location + row for row in execute_data])
+
+    def delete(self, connection, owner: str, group: Optional[str], key: int) -> None:
+        self.migrate(connection, owner, group)
+        connection.execute('DELETE FROM vault_rows WHERE owner = ? AND "group" = ? AND (key = ? OR parent_key = ?)',
+                           self.get_location(owner, group) + (key, key))
+
+    def clear(self, connection, owner: str, group: Optional[str]) -> None:
+        self.migrate(connection, owner, group)
+        connection.execute('DELETE FROM vault_rows WHERE owner = ? AND "group" = ?', self.get_location(owner, group))
+
+def get_storage(name: str):
+    return SingleTableStorage() if name == SingleTableStorage.name else TableStorage()
@@ -1,12 +1,15 @@
 import asyncio
+from collections import OrderedDict
 from dataclasses import dataclass
 import logging
 import sys
 import os
 import math
 import copy
+import time
+import weakref
 import sqlitecloud
-from typing import List, Optional, Any, Dict, Tuple, Union
+from typing import List, Optional, Any, Dict, Set, Tuple, Union
 import apsw
 from concurrent.futures import ThreadPoolExecutor
 
@@ -14,14 +17,46 @@ from libs.utils.list_walker import walk, Child
 from libs.utils.ref import Ref, make_temp
 from libs.utils.hash import fnv1a_64_signed
 from libs.utils.universaltype import UniversalType
+from libs.namuvaultmanager.storage import get_storage
+from libs.namuvaultmanager import codec
 
 MAX_WORKERS = min(32, os.cpu_count() + 4)
+# vaults with fewer rows than this get decoded right away instead of being spread over `decode_executor`,
+# handing a few rows to threads takes longer than decoding them. past this decoding inline stalls the event loop
+# for more than about a millisecond (see benchmarks/vault_loading.py)
+INLINE_ROWS = 512
+
+DEFAULT_MAX_VAULTS = 4096
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_IDLE_TTL = 30 * 60
+# how long writes wait for more writes before they go to the database together
+WRITE_DELAY = 0.5
+# time between moving two tables over to the single table layout, so the migration doesn't hog the database
+MIGRATION_PAUSE = 0.05
+# a failed step (usually the database being busy) is retried after this, doubling every time it fails again
+MIGRATION_RETRY = 1.0
+MIGRATION_MAX_RETRY = 60.0
+# a vault that fails to write is tried again after `write_delay`, doubling every time it fails again up to this
+FLUSH_MAX_RETRY = 60.0
+# what the row tree can hold besides containers, sqlite can't bind complex numbers or ints wider than 64 bits
+ROW_VALUE_TYPES = (bool, int, float, str, bytes)
 
 # ! --------------- !
 # while this class was built with multi-threading in mind
 # it is faster to use this class with python 3.14 without GIL
 # ! --------------- !
 
+def estimate_size(value: Any) -> int:
+    # roughly how much memory a value takes, only used to keep the vault pool within its budget
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        for key, item in value.items():
+            size += estimate_size(key) + estimate_size(item)
+    elif isinstance(value, (list, tuple, set)):
+        for item in value:
+            size += estimate_size(item)
+    return size
+
 @dataclass(slots=True)
 class DatabaseItem:
     key: str
@@ -33,7 +68,9 @@ class DatabaseItem:
     parent_key: str
 
 class VaultManager():
-    def __init__(self, database: str, is_sqlitecloud: bool = False, logger: Optional[logging.Logger] = None):
+    def __init__(self, database: str, is_sqlitecloud: bool = False, logger: Optional[logging.Logger] = None,
+                 max_vaults: int = DEFAULT_MAX_VAULTS, max_bytes: int = DEFAULT_MAX_BYTES, idle_ttl: float = DEFAULT_IDLE_TTL,
+                 write_delay: float = WRITE_DELAY, storage: str = "tables", default_codec: str = codec.ROWS, group_codecs: Optional[Dict[str, str]] = None):
         self.logger = logger
         if not logger:
             self.logger: logging.Logger = logging.getLogger('')
@@ -44,8 +81,44 @@ class VaultManager():
         self.db_connect_str=database
         self.db=self.connect_db()
         self.db.execute("PRAGMA journal_mode=WAL")
+        # "tables" (one table per vault) or "single" (every vault in one table, see `SingleTableStorage`)
+        self.storage = get_storage(storage)
+        self.storage.prepare(self.db)
+        # how new values get written, per group (e.g. {"music": "binary"}) or for everything else.
+        # only affects writes, old values stay readable whatever the codec is
+        self.default_codec = default_codec
+        self.group_codecs: Dict[str, str] = group_codecs or {}
+        self.inline_rows = INLINE_ROWS
+        # created the first time a vault is too big to decode inline and kept around after that
+        self.decode_executor: Optional[ThreadPoolExecutor] = None
+
+        # loaded vaults, from least to most recently used. once there are more than `max_vaults` of them,
+        # they take up more than `max_bytes` or haven't been used for `idle_ttl` seconds they get dropped
+        # and loaded from the database again the next time
+        self.vault_pool: OrderedDict[str, Vault] = OrderedDict()
+        self.max_vaults = max_vaults
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.pool_bytes = 0
+        self.pool_hits = 0
+        self.pool_misses = 0
+        self.pool_evictions = 0
+        # evicted vaults that are still held on to somewhere (e.g. a cog kept a reference) get reused
+        # instead of loading a second copy that would go out of sync with the first one
+        self.live_vaults: weakref.WeakValueDictionary[str, Vault] = weakref.WeakValueDictionary()
+        self.loading_vaults: Dict[str, asyncio.Future] = {}
 
-        self.vault_pool: Dict[str, Vault] = {}
+        # vaults with writes that haven't been flushed yet, see `flush`
+        self.write_delay = write_delay
+        self.dirty_vaults: Dict[str, Vault] = {}
+        self.flush_task: Optional[asyncio.Future] = None
+        self.flush_lock = asyncio.Lock()
+        self.flushes = 0
+        # vaults that failed to write, waiting for `retry_flush`
+        self.flush_retries: Dict[str, Tuple[asyncio.TimerHandle, Vault]] = {}
+
+        # see `start_migration`
+        self.migration_task: Optional[asyncio.Task] = None
 
     def connect_db(self):
         try:
@@ -72,18 +145,32 @@ class VaultManager():
     def get_table(self, owner: str, group: Optional[str] = None):
         return f"{owner}.{group}" if group else str(owner)
 
+    def get_codec(self, group: Optional[str] = None) -> str:
+        return self.group_codecs.get(group, self.default_codec) if group else self.default_codec
+
+    def get_decode_executor(self) -> ThreadPoolExecutor:
+        if not self.decode_executor:
+            self.decode_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="vault-decode")
+        return self.decode_executor
+
     async def populate_dict_from_db_list(self, array: List[Tuple], dict: Dict):
         loop = asyncio.get_running_loop()
         
         get_type_int = UniversalType.get_type_int
         is_container = UniversalType.is_container
         DatabaseItem_ = DatabaseItem
+        ENCODED_TYPE = codec.ENCODED_TYPE
+        decode = codec.decode
 
         def process_chunk(array_chunk):
             local_process = {}
             local_dict = {}
             
             for data in array_chunk:
+                # values from the binary codec are complete in their row
+                if data[2] == ENCODED_TYPE:
+                    local_dict[data[0]] = decode(data[1])
+                    continue
                 database_item = DatabaseItem_(*data)
                 if database_item.value is not None:
                     database_item.value = get_type_int(database_item.data_type)(database_item.value)
@@ -99,9 +186,13 @@ class VaultManager():
             return local_process, local_dict
 
         process = {}
+        inline = len(array) < self.inline_rows
 
         if array:
-            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            if inline:
+                results = [process_chunk(array)]
+            else:
+                executor = self.get_decode_executor()
                 chunk_size = math.ceil(len(array) / MAX_WORKERS)
                 chunks = [array[i:i+chunk_size] for i in range(0, len(array), chunk_size)]
                 tasks = [loop.run_in_executor(executor, process_chunk, chunk) for chunk in chunks]
@@ -114,6 +205,9 @@ class VaultManager():
                         process[k].extend(v)
                     else:
                         process[k] = v
+                # merging big vaults back together takes a while too, so the loop gets a turn after every chunk
+                if not inline:
+                    await asyncio.sleep(0)
 
         def process_item(key, database_items):
             database_items.sort(key=lambda x: (x.parent_id if x.parent_id is not None else -1, 0 if x.continuous_id is None else 1, 0 if x.parent_key is not None else float('-inf')))
@@ -132,28 +226,37 @@ class VaultManager():
                 return key, ref.final()
             return key, None
         
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            tasks = [loop.run_in_executor(executor, process_item, key, items) for key, items in process.items()]
-            for coro in asyncio.as_completed(tasks):
-                key, final_value = await coro
+        def process_items(items_chunk):
+            return [process_item(key, items) for key, items in items_chunk]
+
+        process_list = list(process.items())
+        if inline:
+            results = [process_items(process_list)]
+        else:
+            # in chunks like the rows, a future per key costs more than most keys take to build
+            chunk_size = math.ceil(len(process_list) / MAX_WORKERS) or 1
+            chunks = [process_list[i:i+chunk_size] for i in range(0, len(process_list), chunk_size)]
+            executor = self.get_decode_executor()
+            results = await asyncio.gather(*[loop.run_in_executor(executor, process_items, chunk) for chunk in chunks])
+
+        for result in results:
+            for key, final_value in result:
                 if final_value is not None:
                     dict[key] = final_value
+            if not inline:
+                await asyncio.sleep(0)
+
+    @staticmethod
+    def check_row_value(value: Any) -> None:
+        # raised before anything is written, `vault_store` hands it to the caller
+        if value is None:
+            return
+        value_type = type(value)
+        if value_type not in ROW_VALUE_TYPES:
+            raise TypeError(f"Can't store {value_type.__name__} into a vault")
+        if value_type is int and not codec.INT64_MIN <= value <= codec.INT64_MAX:
+            raise OverflowError("Can't store an int wider than 64 bits into a vault, use the binary codec")
 
-    def create_table(self, connection, table):
-        connection.execute(f"CREATE TABLE IF NOT EXISTS '{table}'(key INTEGER UNIQUE, value, data_type INT, continuous_id INTEGER, id INTEGER, parent_id INTEGER, parent_key INTEGER)")
-    def db_get_all(self, connection, table):
-        return connection.execute(f"""
-            SELECT * FROM '{table}'
-        """).fetchall()
-    def db_execute_delete(self, connection, table, key):
-        connection.execute(f"""
-            DELETE FROM '{table}' WHERE key = ? OR parent_key = ?
-        """, (key, key))
-    def db_execute_clear(self, connection, table):
-        connection.execute(f"""
-            DROP TABLE IF EXISTS '{table}';
-        """)
-    
     @staticmethod
     async def walk_execute_data(key, value):
         execute_data = []
@@ -168,6 +271,8 @@ class VaultManager():
                 current_con_id = con_id if con_id else None
                 item_type_int = UniversalType.get_int(item.type)
                 is_child = type(item) is Child
+                if is_child:
+                    VaultManager.check_row_value(item.value)
                 if depth == -1:
                     if is_child:
                         execute_data.append((key, item.value, item_type_int, None, None, None, None))
@@ -180,80 +285,307 @@ class VaultManager():
                         execute_data.append((None, None, item_type_int, current_con_id, item.id, item.parent_id, key))
         return execute_data
 
-    def db_vault_store(self, connection, table, keys: List[tuple], execute_data: List[tuple]):
+    async def get_execute_data(self, vault: 'Vault', key: int, value: Any) -> List[tuple]:
+        if vault.codec == codec.BINARY:
+            return [(key, codec.encode(value), codec.ENCODED_TYPE, None, None, None, None)]
+        return await self.walk_execute_data(key, value)
+
+    def db_flush(self, connection, writes: List[tuple]) -> Dict[int, Exception]:
+        # everything that changed since the last flush, every vault in the same transaction.
+        # each vault gets its own savepoint so one that can't be written is rolled back on its own
+        # instead of taking everyone else's writes down with it, returns which ones failed
+        failed = {}
         with connection:
-            self.create_table(connection, table)
-            connection.executemany(f"""
-                DELETE FROM '{table}' WHERE key = ? OR parent_key = ?
-            """, keys)
-            connection.executemany(f"""
-                INSERT INTO '{table}' (key, value, data_type, continuous_id, id, parent_id, parent_key)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """, execute_data)
+            for index, (owner, group, cleared, deleted_keys, keys, execute_data) in enumerate(writes):
+                connection.execute("SAVEPOINT vault_write")
+                try:
+                    if cleared:
+                        self.storage.clear(connection, owner, group)
+                    for key in deleted_keys:
+                        self.storage.delete(connection, owner, group, key)
+                    if execute_data:
+                        self.storage.store(connection, owner, group, keys, execute_data)
+                except Exception as e:
+                    connection.execute("ROLLBACK TO vault_write")
+                    failed[index] = e
+                connection.execute("RELEASE vault_write")
+        return failed
+
+    def mark_dirty(self, vault: 'Vault') -> None:
+        self.dirty_vaults[self.get_table(vault.owner, vault.group)] = vault
+        if not self.flush_task:
+            self.flush_task = asyncio.ensure_future(self.delayed_flush())
+
+    def retry_later(self, vault: 'Vault') -> None:
+        # backs off so a vault that keeps failing doesn't get retried (and logged) with every flush
+        table = self.get_table(vault.owner, vault.group)
+        if (retry := self.flush_retries.pop(table, None)):
+            retry[0].cancel()
+        delay = min(self.write_delay * 2 ** vault.flush_failures, FLUSH_MAX_RETRY)
+        vault.flush_failures += 1
+        handle = asyncio.get_running_loop().call_later(delay, self.retry_flush, table)
+        self.flush_retries[table] = (handle, vault)
+
+    def retry_flush(self, table: str) -> None:
+        if (retry := self.flush_retries.pop(table, None)):
+            self.mark_dirty(retry[1])
+
+    async def delayed_flush(self) -> None:
+        # waits a bit so a burst of writes (to the same key or not) ends up in one transaction
+        await asyncio.sleep(self.write_delay)
+        # anything written while this flush runs gets the next one
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self.flush_lock:
+            if not self.dirty_vaults:
+                return
+            vaults = list(self.dirty_vaults.values())
+            self.dirty_vaults.clear()
+
+            batch = []
+            try:
+                for vault in vaults:
+                    cleared, dirty_keys = vault.cleared, vault.dirty_keys
+                    vault.cleared, vault.dirty_keys = False, set()
+                    keys, execute_datas, deleted_keys = [], [], []
+                    for hashed_key in dirty_keys:
+                        # only the latest value of every key gets written, however often it changed in between
+                        if hashed_key in vault.data:
+                            try:
+                                execute_data = await self.get_execute_data(vault, hashed_key, vault.data[hashed_key])
+                            except Exception as e:
+                                # `vault_store` checked it, so the value was changed in place after that.
+                                # it stays dirty (and the vault in the pool) until it gets stored again
+                                self.logger.error(f"Failed to encode a value of vault {self.get_table(vault.owner, vault.group)}.. (Reason: {e})")
+                                vault.dirty_keys.add(hashed_key)
+                                continue
+                            keys.append((hashed_key, hashed_key))
+                            execute_datas.extend(execute_data)
+                        elif not cleared:
+                            deleted_keys.append(hashed_key)
+                    batch.append((vault, (vault.owner, vault.group, cleared, deleted_keys, keys, execute_datas)))
+                    # the vault can't be evicted until the write landed, else loading it again could read the old data
+                    vault.writes_in_flight += 1
+
+                failed = await asyncio.get_running_loop().run_in_executor(None, self.db_flush, await self.get_connection(), [write for _, write in batch])
+                self.flushes += 1
+                for index, (vault, _) in enumerate(batch):
+                    if index in failed:
+                        self.logger.error(f"Failed to write vault {self.get_table(vault.owner, vault.group)}, trying again later.. (Reason: {failed[index]})")
+                        self.restore_dirty(*batch[index])
+                        self.retry_later(vault)
+                    else:
+                        vault.flush_failures = 0
+            except Exception as e:
+                self.logger.error(f"Failed to write to Vault Database, trying again later.. (Reason: {e})")
+                for vault, write in batch:
+                    self.restore_dirty(vault, write)
+                    self.retry_later(vault)
+                # vaults that didn't make it into the batch still have their own dirty state
+                for vault in vaults[len(batch):]:
+                    if vault.is_dirty():
+                        self.mark_dirty(vault)
+            finally:
+                for vault, _ in batch:
+                    vault.writes_in_flight -= 1
+
+    @staticmethod
+    def restore_dirty(vault: 'Vault', write: tuple) -> None:
+        # whatever got written since is newer, so it is only merged back in
+        _, _, cleared, deleted_keys, keys, _ = write
+        vault.cleared = vault.cleared or cleared
+        vault.dirty_keys.update(deleted_keys, (key for key, _ in keys))
+
+    async def close(self) -> None:
+        # writes out everything that is still waiting, anything not flushed by the time the bot exits is lost
+        # vaults waiting to be tried again get one last try
+        for table, (handle, vault) in self.flush_retries.items():
+            handle.cancel()
+            self.dirty_vaults[table] = vault
+        self.flush_retries.clear()
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        if self.migration_task:
+            self.migration_task.cancel()
+            self.migration_task = None
+        await self.flush()
+        if self.decode_executor:
+            self.decode_executor.shutdown(wait=False)
+            self.decode_executor = None
+
+    @staticmethod
+    def get_entry_size(vault: 'Vault', hashed_key: int, value: Any = ...) -> int:
+        # the size of `value` stored under `hashed_key`, or of what is stored there now
+        if value is ...:
+            if hashed_key not in vault.data:
+                return 0
+            value = vault.data[hashed_key]
+        return estimate_size(hashed_key) + estimate_size(value)
+
+    def resize_vault(self, vault: 'Vault', nbytes: int) -> None:
+        if self.vault_pool.get(self.get_table(vault.owner, vault.group)) is vault:
+            self.pool_bytes += nbytes - vault.nbytes
+        vault.nbytes = nbytes
+
     async def vault_store(self, vault: 'Vault', key: Union[str, dict], value: Optional[Any] = None) -> 'Vault':
-        execute_datas = []
-        keys = []
-        is_dict = type(key) is dict
-
-        if is_dict:
-            for key, value in key.items():
-                hashed_key = fnv1a_64_signed(key)
-                if not (hashed_key in vault.data and vault.data[hashed_key] == value):
-                    keys.append((hashed_key, hashed_key))
-                    execute_datas.extend(await self.walk_execute_data(hashed_key, value))
-                    vault.data[hashed_key] = value
-        else:
+        # `vault.data` changes right away so reads see the write, the database catches up with the next flush
+        items = key.items() if type(key) is dict else ((key, value),)
+
+        changes = []
+        for key, value in items:
             hashed_key = fnv1a_64_signed(key)
             if not (hashed_key in vault.data and vault.data[hashed_key] == value):
-                keys.append((hashed_key, hashed_key))
-                execute_datas.extend(await self.walk_execute_data(hashed_key, value))
-                vault.data[hashed_key] = value
-    
-        if execute_datas:
-            await asyncio.get_running_loop().run_in_executor(None, self.db_vault_store, await self.get_connection(), self.get_table(vault.owner, vault.group), keys, execute_datas)
-    
-
-    def db_vault_delete(self, connection, table, key: str):
-        with connection:
-            self.create_table(connection, table)
-            self.db_execute_delete(connection, table, key)
+                # encoded once up front so a value that can't be written fails here, before anything changed,
+                # instead of in the flush later on
+                await self.get_execute_data(vault, hashed_key, value)
+                changes.append((hashed_key, value))
+
+        nbytes = vault.nbytes
+        for hashed_key, value in changes:
+            vault.dirty_keys.add(hashed_key)
+            nbytes += self.get_entry_size(vault, hashed_key, value) - self.get_entry_size(vault, hashed_key)
+            vault.data[hashed_key] = value
+        self.resize_vault(vault, nbytes)
+
+        if vault.is_dirty():
+            self.mark_dirty(vault)
+
     async def vault_delete(self, vault: 'Vault', key: str) -> 'Vault':
         hashed_key = fnv1a_64_signed(key)
-        await asyncio.get_running_loop().run_in_executor(None, self.db_vault_delete, await self.get_connection(), self.get_table(vault.owner, vault.group), hashed_key)
-        try:
+        if hashed_key in vault.data:
+            self.resize_vault(vault, vault.nbytes - self.get_entry_size(vault, hashed_key))
             del vault.data[hashed_key]
-        except Exception:
-            pass
+        vault.dirty_keys.add(hashed_key)
+        self.mark_dirty(vault)
 
-    def db_vault_clear(self, connection, table):
-        with connection:
-            self.db_execute_clear(connection, table)
     async def vault_clear(self, vault: 'Vault') -> 'Vault':
-        await asyncio.get_running_loop().run_in_executor(None, self.db_vault_clear, await self.get_connection(), self.get_table(vault.owner, vault.group))
         vault.data.clear()
+        # whatever was waiting to be written goes away with everything else
+        vault.dirty_keys.clear()
+        vault.cleared = True
+        self.resize_vault(vault, estimate_size(vault.data))
+        self.mark_dirty(vault)
 
-    def db_vault_get_all(self, connection, table):
-        with connection:
-            self.create_table(connection, table)
-            return self.db_get_all(connection, table)
+    def db_vault_get_all(self, connection, owner, group):
+        return self.storage.get_all(connection, owner, group)
     async def vault_get_all(self, vault: 'Vault'):
-        return await asyncio.get_running_loop().run_in_executor(None, self.db_vault_get_all, await self.get_connection(), self.get_table(vault.owner, vault.group))
+        return await asyncio.get_running_loop().run_in_executor(None, self.db_vault_get_all, await self.get_connection(), vault.owner, vault.group)
+
+    async def migrate(self, pause: float = MIGRATION_PAUSE) -> None:
+        # moves every vault that is still in the old layout over while the bot keeps running,
+        # vaults that get used in the meantime are moved right away when they are loaded
+        loop = asyncio.get_running_loop()
+        moved = 0
+        retry = MIGRATION_RETRY
+        while True:
+            try:
+                if not await loop.run_in_executor(None, self.storage.migrate_next, await self.get_connection()):
+                    break
+            except Exception as e:
+                # the table stays in the list, so the same one gets tried again
+                self.logger.error(f"Failed to migrate Vault Database, retrying in {retry:g}s.. (Reason: {e})")
+                await asyncio.sleep(retry)
+                retry = min(retry * 2, MIGRATION_MAX_RETRY)
+                continue
+            moved += 1
+            retry = MIGRATION_RETRY
+            await asyncio.sleep(pause)
+        if moved:
+            self.logger.info(f"Migrated {moved} vault table(s) to the {self.storage.name} layout.")
+
+    def start_migration(self) -> asyncio.Task:
+        # the task is kept here so it isn't garbage collected halfway through, `close` cancels it
+        if not self.migration_task:
+            self.migration_task = asyncio.create_task(self.migrate())
+        return self.migration_task
+
+    async def load_vault(self, owner: str, group: Optional[str] = None) -> 'Vault':
+        vault = Vault(self, owner, group, self.get_codec(group))
+        db_list = await self.vault_get_all(vault)
+        await self.populate_dict_from_db_list(db_list, vault.data)
+        vault.nbytes = estimate_size(vault.data)
+        return vault
 
     async def get(self, owner: str, group: Optional[str] = None) -> 'Vault':
         table = self.get_table(owner, group)
-        if not (vault := self.vault_pool.get(table)):
-            vault = Vault(self, owner, group)
-            db_list = await self.vault_get_all(vault)
-            await self.populate_dict_from_db_list(db_list, vault.data)
-            self.vault_pool[table] = vault
+        if (vault := self.vault_pool.get(table)):
+            self.pool_hits += 1
+            self.vault_pool.move_to_end(table)
+            vault.last_used = time.monotonic()
+            # so idle vaults still expire when everything being asked for is already loaded
+            self.evict_vaults(table)
+            return vault
+
+        self.pool_misses += 1
+        if not (vault := self.live_vaults.get(table)):
+            # everyone asking for the same vault while it loads waits for the same load
+            if not (future := self.loading_vaults.get(table)):
+                future = self.loading_vaults[table] = asyncio.ensure_future(self.load_vault(owner, group))
+                future.add_done_callback(lambda _: self.loading_vaults.pop(table, None))
+            vault = await asyncio.shield(future)
+            # someone else already put it into the pool
+            if self.vault_pool.get(table) is vault:
+                return vault
+            self.live_vaults[table] = vault
+
+        vault.last_used = time.monotonic()
+        self.vault_pool[table] = vault
+        self.pool_bytes += vault.nbytes
+        self.evict_vaults(table)
         return vault
 
+    def evict_vaults(self, keep: Optional[str] = None) -> None:
+        # `keep` is the vault that is being handed out, it stays even if everything older can't go
+        now = time.monotonic()
+        count, nbytes = len(self.vault_pool), self.pool_bytes
+        evicted = []
+        for table, vault in self.vault_pool.items():
+            over_budget = count > self.max_vaults or nbytes > self.max_bytes
+            # the pool is ordered by last use, so once one vault is still in use so are all the ones after it
+            if not over_budget and now - vault.last_used < self.idle_ttl:
+                break
+            # it gets another chance once its writes are done
+            if table == keep or vault.writes_in_flight or vault.is_dirty():
+                continue
+            evicted.append(table)
+            count -= 1
+            nbytes -= vault.nbytes
+        for table in evicted:
+            self.pool_bytes -= self.vault_pool.pop(table).nbytes
+            self.pool_evictions += 1
+
+    def get_pool_stats(self) -> Dict[str, int]:
+        return {
+            "vaults": len(self.vault_pool),
+            "bytes": self.pool_bytes,
+            "max_vaults": self.max_vaults,
+            "max_bytes": self.max_bytes,
+            "hits": self.pool_hits,
+            "misses": self.pool_misses,
+            "evictions": self.pool_evictions,
+            "dirty_vaults": len(self.dirty_vaults),
+            "flushes": self.flushes,
+        }
+
 class Vault():
-    def __init__(self, vault_manager: VaultManager, owner: str, group: Optional[str] = None):
+    def __init__(self, vault_manager: VaultManager, owner: str, group: Optional[str] = None, codec: str = codec.ROWS):
         self.vault_manager: VaultManager = vault_manager
         self.owner: str = owner
         self.group: Optional[str] = group
+        # "rows" or "binary", can be changed at any time since it only decides how the next writes are laid out
+        self.codec: str = codec
         self.data: Dict[str, Any] = {}
+        # bookkeeping for the vault pool
+        self.nbytes = 0
+        self.last_used = time.monotonic()
+        self.writes_in_flight = 0
+        self.flush_failures = 0
+        # what changed since the last flush
+        self.dirty_keys: Set[int] = set()
+        self.cleared = False
 
     async def store(self, key: Union[str, dict], value: Optional[Any] = None):
         await self.vault_manager.vault_store(self, key, value)
@@ -264,6 +596,9 @@ class Vault():
     async def clear(self):
         await self.vault_manager.vault_clear(self)
 
+    def is_dirty(self) -> bool:
+        return self.cleared or bool(self.dirty_keys)
+
     def get(self, key: str, default: Any = None) -> Any:
         value = copy.copy(self.data.get(fnv1a_64_signed(key)))
         if value is None and default is not None:
@@ -18,7 +18,7 @@ import sqlitecloud
 
 from libs.namuscheduler.scheduler import Scheduler
 from libs.namuphishingdetection.phishingdetector import PhishingDetector
-from libs.namuvaultmanager.vaultmanager import VaultManager
+from libs.namuvaultmanager.vaultmanager import VaultManager, DEFAULT_MAX_VAULTS, DEFAULT_MAX_BYTES, DEFAULT_IDLE_TTL, WRITE_DELAY
 from libs.namusettingmanager.discordsettingmanager import DiscordSettingManager
 
 logger = logging.getLogger('discord')
@@ -62,7 +62,14 @@ class Bot(commands.Bot):
         self.quote_db = self.connect_quote_db()
         self.scheduler = None
         self.phishing_detector = None
-        self.vault_manager = VaultManager(sqlitecloud_vault, True, logger) if (sqlitecloud_vault := self.config.get("sqlitecloud-vault")) else VaultManager("vault.db", logger=logger)
+        vault_pool_options = {"max_vaults": self.config.get("vault-pool-max-vaults", DEFAULT_MAX_VAULTS),
+                              "max_bytes": self.config.get("vault-pool-max-bytes", DEFAULT_MAX_BYTES),
+                              "idle_ttl": self.config.get("vault-pool-idle-ttl", DEFAULT_IDLE_TTL),
+                              "write_delay": self.config.get("vault-write-delay", WRITE_DELAY),
+                              "storage": self.config.get("vault-storage", "tables"),
+                              "default_codec": self.config.get("vault-codec", "rows"),
+                              "group_codecs": self.config.get("vault-group-codecs", {})}
+        self.vault_manager = VaultManager(sqlitecloud_vault, True, logger, **vault_pool_options) if (sqlitecloud_vault := self.config.get("sqlitecloud-vault")) else VaultManager("vault.db", logger=logger, **vault_pool_options)
         self.setting_manager: DiscordSettingManager = DiscordSettingManager("data/settings.toml", self.vault_manager)
 
         self.logger = logger
@@ -82,6 +89,11 @@ class Bot(commands.Bot):
 
         aiohttp_session.setup(self.app, EncryptedCookieStorage(secret_key=self.key.decode()))
 
+    async def close(self):
+        # cogs get unloaded in here and some of them (music) still write to their vaults while unloading
+        await super().close()
+        await self.vault_manager.close()
+
     async def start_web(self):
         runner = web.AppRunner(self.app)
         await runner.setup()
@@ -153,6 +165,7 @@ async def main():
         await bot.get_scheduler()
         await bot.get_phishing_detector()
         await bot.load_extensions()
+        bot.vault_manager.start_migration()
         await bot.start_web()
         await bot.start(bot.token)
 
@@ -0,0 +1,22 @@
+import asyncio
+
+from libs.namumusic.queuesnapshot import serialize_song, deserialize_song
+from libs.namumusic.ytdlpaudio import YTDLPAudio
+from libs.namumusic.ytdlpmusicplayer import YTDLPMusicPlayer
+
+ATTACHMENT_URL = "https://cdn.discordapp.com/attachments/1/2/song.mp3"
+
+def test_restore_attachment():
+    async def run():
+        attachment = await YTDLPAudio(ATTACHMENT_URL, streamable=False, cache_on_init=False)
+        metadata, streamable, _ = deserialize_song(serialize_song(attachment))
+
+        player = YTDLPMusicPlayer(None)
+        audios = await player.restore([(metadata, streamable)])
+        return audios[0]
+
+    audio = asyncio.run(run())
+    assert audio.metadata.stream_url == ATTACHMENT_URL
+    assert audio.metadata.title == "song.mp3"
+    assert audio.metadata.author == "Discord Attachment"
+    assert not audio.streamable
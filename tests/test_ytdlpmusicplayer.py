@@ -0,0 +1,24 @@
+import asyncio
+
+from libs.namumusic.metadata import Metadata
+from libs.namumusic.pcmcache import PCMCache
+from libs.namumusic.ytdlpmusicplayer import YTDLPMusicPlayer
+
+class VoiceClient():
+    def stop(self):
+        pass
+
+def test_self_clean_up_releases_every_track():
+    async def run():
+        pcm_cache = PCMCache()
+        player = YTDLPMusicPlayer(VoiceClient(), pcm_cache=pcm_cache)
+        audios = await player.restore([(Metadata(url=f"https://youtu.be/{i:011d}"), True) for i in range(4)])
+        # what starting and prefetching them does, without running ffmpeg
+        tracks = [audio.acquire_track() for audio in audios]
+        player.self_clean_up()
+        pcm_cache.clear()
+        return player, tracks
+
+    player, tracks = asyncio.run(run())
+    assert not player.queue
+    assert [track.users for track in tracks] == [0, 0, 0, 0]